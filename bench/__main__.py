@@ -0,0 +1,252 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from datetime import datetime, timezone
+
+from digest import ConfigManager, TelegramWorker, DigestPipeline, Prefetcher, LoopMonitor, ChatSkipped
+from bench.fake_gemini import FakeGeminiServer
+from bench.fake_telegram import FakeTelegramClient
+
+# End-to-end digest benchmark against local fakes:
+#   python -m bench --dialogs 40 --unread 200 --runs 2 --out result.json
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m bench",
+        description="Run the digest pipeline against a fake Telegram client and a local fake Gemini server.",
+    )
+    data = parser.add_argument_group("fake Telegram")
+    data.add_argument("--dialogs", type=int, default=40, help="selected dialogs (default: 40)")
+    data.add_argument("--unread", type=int, default=50, help="unread messages per dialog (default: 50)")
+    data.add_argument("--history", type=int, default=None, help="total messages per dialog (default: unread + 100)")
+    data.add_argument("--senders", type=int, default=8, help="distinct senders (default: 8)")
+    data.add_argument("--reply-density", type=float, default=0.2, help="share of replies (default: 0.2)")
+    data.add_argument("--text-words", type=int, default=12, help="average words per message (default: 12)")
+    data.add_argument("--tg-latency", type=float, default=0.05, help="seconds per Telegram request (default: 0.05)")
+    llm = parser.add_argument_group("fake Gemini")
+    llm.add_argument("--llm-latency", type=float, default=0.8, help="seconds per request (default: 0.8)")
+    llm.add_argument("--llm-jitter", type=float, default=0.3, help="+/- seconds of latency jitter (default: 0.3)")
+    llm.add_argument("--rate-429", type=float, default=0.0, help="share of requests rejected with 429 (default: 0)")
+    llm.add_argument("--llm-slow-rate", type=float, default=0.0,
+                     help="share of requests that take --llm-slow-latency instead (default: 0)")
+    llm.add_argument("--llm-slow-latency", type=float, default=10.0, help="seconds per slow request (default: 10)")
+    llm.add_argument("--backends", type=int, default=1,
+                     help="fake servers; the first is used through the proxy, the others as OpenAI-compatible "
+                          "backends for hedged requests (default: 1)")
+    llm.add_argument("--stream", action="store_true", help="use the streaming endpoint")
+    run = parser.add_argument_group("run")
+    run.add_argument("-j", "--concurrency", type=int, default=4, help="max_concurrency (default: 4)")
+    run.add_argument("--runs", type=int, default=1, help="repeat the digest in the same workdir (warm store/cache)")
+    run.add_argument("--prefetch", action="store_true",
+                     help="run the background prefetch to completion before the first digest")
+    run.add_argument("--tracemalloc", action="store_true", help="also report the Python heap peak (slower)")
+    run.add_argument("--seed", type=int, default=1)
+    run.add_argument("--config", action="append", default=[], metavar="KEY=JSON",
+                     help="extra config.json value, e.g. chunk_token_budget=8000 (repeatable)")
+    run.add_argument("-o", "--out", help="write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS; the resource
+    # module does not exist on Windows.
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def latency_stats(values):
+    return {
+        "count": len(values),
+        "mean": statistics.fmean(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+class TimedPipeline(DigestPipeline):
+    def __init__(self, worker):
+        super().__init__(worker)
+        self.latencies = {}
+        self.started = {}
+
+    async def summarize(self, dialog, on_partial=None):
+        started = time.perf_counter()
+        try:
+            return await super().summarize(dialog, on_partial)
+        finally:
+            self.latencies[dialog.id] = time.perf_counter() - started
+
+    # Batched chats are timed from the start of their history fetch to the
+    # end of the request that answered them.
+    async def prepare_batch_item(self, idx, dialog):
+        self.started[dialog.id] = time.perf_counter()
+        return await super().prepare_batch_item(idx, dialog)
+
+    async def summarize_item(self, item, on_partial=None):
+        try:
+            return await super().summarize_item(item, on_partial)
+        finally:
+            self.latencies[item.dialog.id] = time.perf_counter() - self.started[item.dialog.id]
+
+    async def summarize_batch(self, items):
+        try:
+            return await super().summarize_batch(items)
+        finally:
+            for item in items:
+                self.latencies[item.dialog.id] = time.perf_counter() - self.started[item.dialog.id]
+
+async def run_once(worker, args):
+    pipeline = TimedPipeline(worker)
+    first_output = {}
+    started = time.perf_counter()
+
+    def on_partial(idx, text):
+        first_output.setdefault(idx, time.perf_counter() - started)
+
+    requests_before = worker.client.requests
+    dialogs = [row async for row in worker.iter_dialog_rows(limit=args.dialogs)]
+    failures = skipped = 0
+    async for idx, summary, error in pipeline.run(dialogs, args.concurrency, on_partial if args.stream else None):
+        if isinstance(error, ChatSkipped):
+            skipped += 1
+            continue
+        first_output.setdefault(idx, time.perf_counter() - started)
+        if error is not None:
+            failures += 1
+    wall = time.perf_counter() - started
+
+    return {
+        "wall_seconds": wall,
+        "chats": len(dialogs),
+        "failed_chats": failures,
+        "skipped_chats": skipped,
+        "chats_per_second": len(dialogs) / wall if wall else None,
+        "messages_per_second": len(dialogs) * args.unread / wall if wall else None,
+        "chat_latency": latency_stats(list(pipeline.latencies.values())),
+        "first_output": latency_stats(list(first_output.values())),
+        "telegram_requests": worker.client.requests - requests_before,
+        "stages": worker.metrics.stage_stats(),
+    }
+
+async def run_benchmark(args, servers):
+    backends = [{"type": "gemini", "name": "proxy", "proxy": True}] + [
+        {"type": "openai", "name": f"openai-{number}", "url": server.openai_base, "model": "bench"}
+        for number, server in enumerate(servers[1:], 1)
+    ]
+    ConfigManager.save({
+        "api_id": "1", "api_hash": "bench", "gemini_key": "bench",
+        "proxy_base": servers[0].proxy_base, "max_concurrency": args.concurrency, "llm_backends": backends,
+        **{key: json.loads(value) for key, value in (item.split("=", 1) for item in args.config)},
+    })
+    worker = TelegramWorker()
+    worker.client = FakeTelegramClient(
+        dialogs=args.dialogs, unread=args.unread, total_messages=args.history, senders=args.senders,
+        reply_density=args.reply_density, text_words=args.text_words, page_latency=args.tg_latency,
+        seed=args.seed,
+    )
+    worker.metrics.enabled = True
+    await worker.client.connect()
+    monitor = LoopMonitor().start()
+    try:
+        prefetch = None
+        if args.prefetch:
+            prefetcher = Prefetcher(worker)
+            requests_before = worker.client.requests
+            started = time.perf_counter()
+            prefetcher.start([row async for row in worker.iter_dialog_rows(limit=args.dialogs)])
+            await prefetcher.task
+            prefetch = {
+                "seconds": time.perf_counter() - started,
+                "chats": prefetcher.done,
+                "telegram_requests": worker.client.requests - requests_before,
+            }
+        runs = []
+        for _ in range(args.runs):
+            runs.append(await run_once(worker, args))
+        http = worker.http_stats
+        return runs, prefetch, {
+            "requests": http.requests,
+            "new_connections": http.new_connections,
+            "reused_connections": http.reused_connections,
+            "summary_cache_hits": worker.summary_cache.hits,
+            "summary_cache_misses": worker.summary_cache.misses,
+            "prompt_tokens_verbose": worker.prompt_tokens_verbose,
+            "prompt_tokens_compact": worker.prompt_tokens_compact,
+            "batch_requests": worker.batch_requests,
+            "batched_chats": worker.batched_chats,
+            "hedged_requests": worker.hedged_requests,
+            "hedges_won": worker.hedges_won,
+            "backends": [backend.summary() for backend in worker.llm_backends],
+            "loop": monitor.stats(),
+            "loop_stalls": monitor.report().splitlines(),
+        }
+    finally:
+        await monitor.stop()
+        await worker.close()
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    servers = [
+        FakeGeminiServer(latency=args.llm_latency, jitter=args.llm_jitter, rate_429=args.rate_429,
+                         slow_rate=args.llm_slow_rate, slow_latency=args.llm_slow_latency, seed=args.seed + number).start()
+        for number in range(max(1, args.backends))
+    ]
+    # Config, session and message store all live in a throwaway directory.
+    workdir = tempfile.TemporaryDirectory(prefix="tg-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir.name)
+    try:
+        runs, prefetch, client_stats = asyncio.run(run_benchmark(args, servers))
+    finally:
+        os.chdir(cwd)
+        for server in servers:
+            server.stop()
+        workdir.cleanup()
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "prefetch": prefetch,
+        "runs": runs,
+        "client": client_stats,
+        "server": servers[0].stats(),
+        "hedge_servers": [server.stats() for server in servers[1:]],
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if args.tracemalloc:
+        report["peak_python_heap_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+import asyncio
+import json
+import random
+import re
+import threading
+import urllib.parse
+
+from aiohttp import web
+
+# Local stand-in for the Gemini proxy. Accepts the same `?url=` form the
+# worker sends to PROXY_BASE and answers generateContent or
+# streamGenerateContent (SSE) depending on the wrapped URL. The same server
+# also answers OpenAI-style /v1/chat/completions.
+
+class FakeGeminiServer:
+    def __init__(self, latency=0.8, jitter=0.3, rate_429=0.0, retry_after=1, summary_words=80,
+                 stream_events=8, slow_rate=0.0, slow_latency=10.0, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.summary_words = summary_words
+        self.stream_events = stream_events
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.rejected = 0
+        self.slow = 0
+        self.dropped = 0
+        self.prompt_chars = 0
+        self.port = None
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    @property
+    def proxy_base(self):
+        return f"http://127.0.0.1:{self.port}/?url="
+
+    @property
+    def openai_base(self):
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def _summary(self, prompt):
+        # Batched prompts get one '### CHAT N' section per chat, like the
+        # structured answer the real model is asked for.
+        chats = re.split(r"^=== CHAT (\d+): .*$", prompt, flags=re.MULTILINE)
+        if len(chats) > 1:
+            return "\n\n".join(
+                f"### CHAT {number}\n{self._summary(section)}" for number, section in zip(chats[1::2], chats[2::2])
+            )
+        words = [w for w in prompt.split() if w.isalpha()][:self.summary_words] or ["empty"]
+        return "Summary: " + " ".join(words)
+
+    async def _delay(self):
+        # `slow_rate` of the requests take `slow_latency` instead: the tail
+        # that hedged requests are meant to cut.
+        latency = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+        if self.rng.random() < self.slow_rate:
+            self.slow += 1
+            latency = self.slow_latency
+        await asyncio.sleep(latency)
+
+    def _rejected(self):
+        if self.rng.random() >= self.rate_429:
+            return None
+        self.rejected += 1
+        return web.json_response(
+            {"error": {"code": 429, "message": "Resource has been exhausted", "status": "RESOURCE_EXHAUSTED"}},
+            status=429, headers={"Retry-After": str(self.retry_after)},
+        )
+
+    async def _stream(self, request, events):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        try:
+            await response.prepare(request)
+            for event in events:
+                await response.write(f"data: {event}\r\n\r\n".encode("utf-8"))
+                await asyncio.sleep(0.01)
+            await response.write_eof()
+        except ConnectionResetError:
+            # The client cancelled the request, e.g. a hedge that lost.
+            self.dropped += 1
+        return response
+
+    def _pieces(self, text):
+        step = max(1, len(text) // self.stream_events)
+        return [text[start:start + step] for start in range(0, len(text), step)]
+
+    async def handle(self, request):
+        self.requests += 1
+        payload = await request.json()
+        prompt = payload["contents"][0]["parts"][0]["text"]
+        self.prompt_chars += len(prompt)
+        target = urllib.parse.unquote(request.query.get("url", ""))
+
+        await self._delay()
+        rejected = self._rejected()
+        if rejected is not None:
+            return rejected
+
+        text = self._summary(prompt)
+        if "streamGenerateContent" not in target:
+            return web.json_response({"candidates": [{"content": {"parts": [{"text": text}]}, "finishReason": "STOP"}]})
+        return await self._stream(request, [
+            json.dumps({"candidates": [{"content": {"parts": [{"text": piece}]}}]}) for piece in self._pieces(text)
+        ])
+
+    async def handle_openai(self, request):
+        self.requests += 1
+        payload = await request.json()
+        prompt = payload["messages"][-1]["content"]
+        self.prompt_chars += sum(len(message["content"]) for message in payload["messages"])
+
+        await self._delay()
+        rejected = self._rejected()
+        if rejected is not None:
+            return rejected
+
+        text = self._summary(prompt)
+        if not payload.get("stream"):
+            return web.json_response({"choices": [
+                {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+            ]})
+        return await self._stream(request, [
+            json.dumps({"choices": [{"index": 0, "delta": {"content": piece}}]}) for piece in self._pieces(text)
+        ] + ["[DONE]"])
+
+    async def _start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/", self.handle)
+        app.router.add_post("/v1/chat/completions", self.handle_openai)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def start(self):
+        # The server gets its own thread and loop so its work does not
+        # show up in the client-side timings.
+        ready = threading.Event()
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self._start())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=serve, name="fake-gemini", daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    def stats(self):
+        return {"requests": self.requests, "rejected_429": self.rejected, "slow": self.slow,
+                "dropped": self.dropped, "prompt_chars": self.prompt_chars}
@@ -0,0 +1,136 @@
+import asyncio
+import inspect
+import random
+
+from datetime import datetime, timedelta, timezone
+
+from telethon.tl.types import User, InputPeerUser
+
+# Stand-in for telethon.TelegramClient that serves synthetic dialogs and
+# messages. Only the calls TelegramWorker makes are implemented.
+
+WORDS = ("deploy", "release", "review", "meeting", "lunch", "bug", "fix", "today", "tomorrow",
+         "server", "client", "merge", "branch", "ticket", "call", "docs", "test", "ok", "thanks", "why")
+
+class FakeDialog:
+    def __init__(self, id, name, kind, unread_count):
+        self.id = id
+        self.name = name
+        self.is_group = kind == "group"
+        self.is_channel = kind == "channel"
+        self.is_user = kind == "user"
+        self.unread_count = unread_count
+        self.input_entity = InputPeerUser(id, 0)
+        self.entity = self.input_entity
+
+class FakeMessage:
+    def __init__(self, id, reply_to_msg_id, sender, date, text):
+        self.id = id
+        self.reply_to_msg_id = reply_to_msg_id
+        self.sender = sender
+        self.sender_id = sender.id
+        self.date = date
+        self.text = text
+
+class FakeTelegramClient:
+    def __init__(self, dialogs=40, unread=50, total_messages=None, senders=8, reply_density=0.2,
+                 text_words=12, page_latency=0.05, page_size=100, seed=1):
+        self.rng = random.Random(seed)
+        self.unread = unread
+        self.total_messages = total_messages or unread + 100
+        self.reply_density = reply_density
+        self.text_words = text_words
+        self.page_latency = page_latency
+        self.page_size = page_size
+        self.requests = 0
+        self.connected = False
+        self.handlers = []
+
+        self.users = [User(id=1000 + i, first_name=f"User{i}") for i in range(senders)]
+        kinds = ("user", "group", "channel")
+        self.dialogs = [
+            FakeDialog(100 + i, f"Chat {i}", kinds[i % len(kinds)], unread)
+            for i in range(dialogs)
+        ]
+        self.started = datetime.now(timezone.utc) - timedelta(hours=6)
+
+    async def connect(self):
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    async def disconnect(self):
+        self.connected = False
+
+    async def is_user_authorized(self):
+        return True
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append((callback, event))
+
+    def remove_event_handler(self, callback, event=None):
+        self.handlers = [(cb, ev) for cb, ev in self.handlers if cb != callback]
+
+    async def dispatch(self, update):
+        # Feeds a raw update to the handlers the way TelegramClient does,
+        # builder filters included; events are not bound to this client.
+        for callback, builder in list(self.handlers):
+            event = builder.build(update, None, None)
+            if not event:
+                continue
+            event.original_update = update
+            if not builder.resolved:
+                await builder.resolve(self)
+            passed = builder.filter(event)
+            if inspect.isawaitable(passed):
+                passed = await passed
+            if passed:
+                await callback(event)
+
+    async def _round_trip(self):
+        self.requests += 1
+        if self.page_latency:
+            await asyncio.sleep(self.page_latency)
+
+    async def iter_dialogs(self, limit=None, archived=None):
+        for start in range(0, len(self.dialogs[:limit]), self.page_size):
+            await self._round_trip()
+            for dialog in self.dialogs[start:start + self.page_size][:limit]:
+                yield dialog
+
+    def _message(self, dialog_id, msg_id):
+        # Deterministic per (dialog, id) so repeated fetches return the same
+        # history and delta sync / caching behave like the real thing.
+        rng = random.Random(dialog_id * 1_000_003 + msg_id)
+        reply_to = None
+        if msg_id > 1 and rng.random() < self.reply_density:
+            reply_to = rng.randint(max(1, msg_id - 20), msg_id - 1)
+        words = rng.randint(max(1, self.text_words // 2), self.text_words * 2)
+        text = " ".join(rng.choice(WORDS) for _ in range(words)) if rng.random() > 0.05 else None
+        date = self.started + timedelta(seconds=msg_id * 10)
+        return FakeMessage(msg_id, reply_to, rng.choice(self.users), date, text)
+
+    async def iter_messages(self, entity, limit=None, min_id=0, offset_id=0):
+        dialog_id = entity.user_id
+        count = 0
+        msg_id = offset_id - 1 if offset_id else self.total_messages
+        await self._round_trip()
+        while msg_id > min_id and (limit is None or count < limit):
+            if count and count % self.page_size == 0:
+                await self._round_trip()
+            yield self._message(dialog_id, msg_id)
+            count += 1
+            msg_id -= 1
+
+    async def get_messages(self, entity, limit=None, min_id=0, offset_id=0):
+        return [msg async for msg in self.iter_messages(entity, limit=limit, min_id=min_id, offset_id=offset_id)]
+
+    async def get_entity(self, ids):
+        await self._round_trip()
+        by_id = {user.id: user for user in self.users}
+        if isinstance(ids, list):
+            return [by_id[i] for i in ids if i in by_id]
+        if ids not in by_id:
+            raise ValueError(f"Could not find the input entity for {ids}")
+        return by_id[ids]
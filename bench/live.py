@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+
+from datetime import datetime, timezone
+
+from telethon import events
+from telethon.tl import types
+
+from digest import TelegramWorker, LiveUpdates, DialogRow
+from bench.fake_telegram import FakeTelegramClient
+
+# Feeds Telegram updates through the same event builders and filters the
+# real client uses and checks the unread counts the chat list would show:
+#   python -m bench.live
+
+DIALOG = 100
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m bench.live",
+        description="Check the unread counts LiveUpdates derives from new-message and read updates.",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="also list the checks that pass")
+    return parser.parse_args(argv)
+
+def new_message(dialog_id, msg_id, out=False):
+    message = types.Message(
+        id=msg_id, peer_id=types.PeerUser(dialog_id), date=datetime.now(timezone.utc),
+        message=f"message {msg_id}", out=out,
+    )
+    return types.UpdateNewMessage(message, pts=msg_id, pts_count=1)
+
+def read_inbox(dialog_id, max_id, still_unread):
+    return types.UpdateReadHistoryInbox(
+        peer=types.PeerUser(dialog_id), max_id=max_id, still_unread_count=still_unread, pts=1, pts_count=1,
+    )
+
+def read_outbox(dialog_id, max_id):
+    return types.UpdateReadHistoryOutbox(peer=types.PeerUser(dialog_id), max_id=max_id, pts=1, pts_count=1)
+
+class Session:
+    # One LiveUpdates on a fresh worker and fake client.
+    def __init__(self, unread):
+        self.worker = TelegramWorker()
+        self.worker.client = FakeTelegramClient(dialogs=1, unread=unread, page_latency=0)
+        self.unknown = []
+        self.live = LiveUpdates(self.worker, on_unknown=self.unknown.append).start()
+        self.live.seed([DialogRow(DIALOG, "Chat 0", "user", unread)])
+
+    async def dispatch(self, *updates):
+        for update in updates:
+            await self.worker.client.dispatch(update)
+        return self.live.unread.get(DIALOG)
+
+    async def close(self):
+        self.live.stop()
+        await self.worker.close()
+
+async def inbox_read_lowers_count(session):
+    await session.dispatch(*(new_message(DIALOG, msg_id) for msg_id in range(101, 106)))
+    return await session.dispatch(read_inbox(DIALOG, 103, 2)), 2
+
+async def outbox_read_keeps_count(session):
+    await session.dispatch(*(new_message(DIALOG, msg_id) for msg_id in range(101, 106)))
+    return await session.dispatch(read_outbox(DIALOG, 105)), 5
+
+async def unsynced_read_uses_server_count(session):
+    # Five unread (101-105) known only from the dialog list.
+    return await session.dispatch(read_inbox(DIALOG, 102, 3)), 3
+
+async def unsynced_read_without_server_count(session):
+    # Events built outside the client carry no original update; nothing
+    # after max_id is known, so the count must not change.
+    event = events.MessageRead.build(read_inbox(DIALOG, 102, 3))
+    await session.live._on_read(event)
+    return session.live.unread.get(DIALOG), 5
+
+async def unknown_chat_reported_once(session):
+    # Chat 999 is not in the dialog list (archived, or past the first page).
+    await session.dispatch(*(new_message(999, msg_id) for msg_id in range(1, 4)))
+    return session.unknown, [999]
+
+CHECKS = [
+    # (name, unread count in the dialog list, check)
+    ("inbox read lowers the count", 0, inbox_read_lowers_count),
+    ("outbox read keeps the count", 0, outbox_read_keeps_count),
+    ("read in an unsynced chat uses Telegram's count", 5, unsynced_read_uses_server_count),
+    ("read in an unsynced chat without a count keeps it", 5, unsynced_read_without_server_count),
+    ("messages in an unlisted chat report it once", 0, unknown_chat_reported_once),
+]
+
+async def run_checks(args):
+    failures = 0
+    for name, unread, check in CHECKS:
+        session = Session(unread)
+        try:
+            got, expected = await check(session)
+        finally:
+            await session.close()
+        if got != expected:
+            failures += 1
+            print(f"FAIL {name}: expected {expected}, got {got}")
+        elif args.verbose:
+            print(f"ok   {name}")
+    return failures
+
+def main(argv=None):
+    args = parse_args(argv)
+    # The worker's message store is created in a throwaway directory.
+    workdir = tempfile.TemporaryDirectory(prefix="tg-live-")
+    cwd = os.getcwd()
+    os.chdir(workdir.name)
+    try:
+        failures = asyncio.run(run_checks(args))
+    finally:
+        os.chdir(cwd)
+        workdir.cleanup()
+    print(f"{len(CHECKS) - failures}/{len(CHECKS)} checks passed")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
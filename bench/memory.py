@@ -0,0 +1,92 @@
+import argparse
+import gc
+import json
+import sys
+import tracemalloc
+
+from collections import namedtuple
+
+from telethon.tl import types
+
+from digest import MessageRecord
+from bench.fake_telegram import FakeTelegramClient
+
+# Heap cost of keeping a chat's messages around, per representation:
+#   python -m bench.memory --messages 20000
+
+# What get_chat_history used to hand to formatting before MessageRecord.
+TupleRecord = namedtuple("TupleRecord", "id reply_to_msg_id sender_id date text")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m bench.memory",
+        description="Compare the Python heap held by Telethon messages and by the records the worker keeps.",
+    )
+    parser.add_argument("--messages", type=int, default=20000, help="messages per representation (default: 20000)")
+    parser.add_argument("--text-words", type=int, default=12, help="average words per message (default: 12)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--out", help="write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+def telethon_message(fake, dialog_id):
+    # Lower bound for what iter_messages yields: no client, entities,
+    # media or forward headers attached.
+    reply_to = types.MessageReplyHeader(reply_to_msg_id=fake.reply_to_msg_id) if fake.reply_to_msg_id else None
+    return types.Message(
+        id=fake.id, peer_id=types.PeerChat(dialog_id), date=fake.date, message=fake.text or "",
+        from_id=types.PeerUser(fake.sender_id), reply_to=reply_to,
+    )
+
+def measure(build, sources):
+    # Only the objects built from the (already allocated) sources are counted;
+    # message texts are shared with the sources, so this is per-message overhead.
+    gc.collect()
+    before = tracemalloc.take_snapshot()
+    kept = [build(source) for source in sources]
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del kept
+    return {"total_mb": size / (1024 * 1024), "bytes_per_message": size / len(sources)}
+
+def main(argv=None):
+    args = parse_args(argv)
+    dialog_id = 100
+    client = FakeTelegramClient(dialogs=1, unread=args.messages, text_words=args.text_words, seed=args.seed)
+    fakes = [client._message(dialog_id, msg_id) for msg_id in range(1, args.messages + 1)]
+    texts = [fake.text or "" for fake in fakes]
+
+    tracemalloc.start()
+    messages = [telethon_message(fake, dialog_id) for fake in fakes]
+    results = {
+        # Telethon's own text property is None without a client, so the
+        # conversions read `message` here instead.
+        "telethon_message": measure(lambda fake: telethon_message(fake, dialog_id), fakes),
+        "namedtuple": measure(
+            lambda msg: TupleRecord(msg.id, msg.reply_to_msg_id, msg.sender_id, int(msg.date.timestamp()), msg.message),
+            messages,
+        ),
+        "slots_record": measure(
+            lambda msg: MessageRecord(msg.id, msg.reply_to_msg_id, msg.sender_id, int(msg.date.timestamp()), msg.message),
+            messages,
+        ),
+    }
+    tracemalloc.stop()
+
+    report = {
+        "python": sys.version.split()[0],
+        "params": vars(args),
+        "text_bytes_per_message": sum(len(text) for text in texts) / len(texts),
+        "results": results,
+        "saving_vs_telethon": 1 - results["slots_record"]["bytes_per_message"] / results["telethon_message"]["bytes_per_message"],
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+import time
+
+STARTED = time.perf_counter()
+
+import argparse
+import asyncio
+import html
+import json
+import os
+import sys
+
+from digest import TelegramWorker, DigestPipeline, LoopMonitor, ChatSkipped, offload
+
+FORMATS = ("text", "markdown", "json", "html")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Summarize unread Telegram chats without the GUI. "
+                    "Uses config.json and the session created by the GUI login."
+    )
+    parser.add_argument("-c", "--chat", action="append", default=[], metavar="SELECTOR",
+                        help="chat id or part of its name (repeatable); default: all chats with unread messages")
+    parser.add_argument("--min-unread", type=int, default=1,
+                        help="skip chats with fewer unread messages (default: 1)")
+    parser.add_argument("--limit", type=int, default=120, help="how many dialogs to scan (default: 120)")
+    parser.add_argument("-j", "--concurrency", type=int, default=None,
+                        help="chats analyzed at once (default: max_concurrency from config, or 4)")
+    parser.add_argument("--time-budget", type=float, default=None, metavar="SECONDS",
+                        help="do not start chats that would not finish within SECONDS (default: time_budget_seconds from config)")
+    parser.add_argument("--keep-order", action="store_true",
+                        help="analyze chats in list order instead of pinned, direct, groups, channels, cheapest first")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="text", help="output format (default: text)")
+    parser.add_argument("-o", "--output", help="write the digest to this file instead of stdout")
+    parser.add_argument("--workdir", help="directory with config.json and the session file")
+    parser.add_argument("--metrics", action="store_true", help="time each stage and print a summary table to stderr")
+    parser.add_argument("--metrics-out", metavar="PATH",
+                        help="export stage timings as JSON lines, or Prometheus text if PATH ends with .prom")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print timings and HTTP/cache stats to stderr")
+    return parser.parse_args(argv)
+
+def select_dialogs(rows, selectors, min_unread):
+    if not selectors:
+        return [row for row in rows if row.unread_count >= min_unread]
+
+    selected = []
+    for selector in selectors:
+        needle = selector.strip().lower()
+        for row in rows:
+            if row in selected:
+                continue
+            if needle == str(row.id) or needle in row.name.lower():
+                selected.append(row)
+    return [row for row in selected if row.unread_count >= min_unread]
+
+def render_entry(fmt, dialog, summary, error):
+    text = summary if error is None else f"Error: {error}"
+    if fmt == "markdown":
+        return f"## {dialog.name} (+{dialog.unread_count})\n\n{text}\n\n"
+    if fmt == "html":
+        from digest import markdown_html
+
+        body = markdown_html(text)
+        return f"<section>\n<h2>{html.escape(dialog.name)} (+{dialog.unread_count})</h2>\n{body}\n</section>\n"
+    return f"=== {dialog.name} (+{dialog.unread_count}) ===\n{text}\n\n"
+
+async def run_digest(args, out):
+    worker = TelegramWorker()
+    if args.metrics or args.metrics_out:
+        worker.metrics.enabled = True
+    monitor = LoopMonitor().start() if args.verbose else None
+    try:
+        if not await worker.connect_and_check_auth():
+            print("Not logged in: start the GUI once to set up the Telegram session.", file=sys.stderr)
+            return 2
+
+        rows = [row async for row in worker.iter_dialog_rows(limit=args.limit)]
+        dialogs = select_dialogs(rows, args.chat, args.min_unread)
+        if not dialogs:
+            print("No matching chats with unread messages.", file=sys.stderr)
+            return 1
+
+        pipeline = DigestPipeline(worker)
+        if not args.keep_order:
+            dialogs = pipeline.scheduler.order(dialogs)
+
+        # Entries are written in the order chats are started in as soon as
+        # every chat above them is finished, like the results view in the GUI.
+        results = [None] * len(dialogs)
+        next_entry = 0
+        failures = skipped = 0
+        if args.format == "html":
+            out.write("<!DOCTYPE html>\n<html><head><meta charset='utf-8'><title>Telegram digest</title></head><body>\n")
+
+        async for idx, summary, error in pipeline.run(dialogs, args.concurrency, time_budget=args.time_budget):
+            results[idx] = (summary, error)
+            if isinstance(error, ChatSkipped):
+                skipped += 1
+            else:
+                failures += error is not None
+            if args.verbose:
+                print(f"[{time.perf_counter() - STARTED:7.2f}s] done: {dialogs[idx].name}", file=sys.stderr)
+            if args.format == "json":
+                continue
+            while next_entry < len(results) and results[next_entry] is not None:
+                if args.format == "html":
+                    entry = await offload(render_entry, args.format, dialogs[next_entry], *results[next_entry])
+                else:
+                    entry = render_entry(args.format, dialogs[next_entry], *results[next_entry])
+                out.write(entry)
+                out.flush()
+                next_entry += 1
+
+        if args.format == "json":
+            json.dump([
+                {"id": dialog.id, "name": dialog.name, "unread": dialog.unread_count,
+                 "summary": summary, "error": None if error is None else str(error)}
+                for dialog, (summary, error) in zip(dialogs, results)
+            ], out, ensure_ascii=False, indent=2)
+            out.write("\n")
+        elif args.format == "html":
+            out.write("</body></html>\n")
+
+        if skipped:
+            print(f"{skipped} chats skipped: time budget used up.", file=sys.stderr)
+        if args.verbose:
+            print(f"{worker.stats_summary()} | {monitor.summary()}", file=sys.stderr)
+            if monitor.stalls:
+                print(monitor.report(), file=sys.stderr)
+        if args.metrics:
+            print(worker.metrics.summary_table(), file=sys.stderr)
+        if args.metrics_out:
+            worker.metrics.export(args.metrics_out)
+        return 1 if failures else 0
+    finally:
+        if monitor is not None:
+            await monitor.stop()
+        await worker.close()
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.workdir:
+        os.chdir(args.workdir)
+    if args.verbose:
+        print(f"startup: {(time.perf_counter() - STARTED) * 1000:.0f} ms", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as out:
+            return asyncio.run(run_digest(args, out))
+    return asyncio.run(run_digest(args, sys.stdout))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2354 @@
+import sys
+import asyncio
+import urllib.parse
+import json
+import os
+import time
+import tempfile
+import sqlite3
+import hashlib
+import heapq
+import math
+import random
+import re
+import threading
+import traceback
+from email.utils import parsedate_to_datetime
+
+from collections import OrderedDict, deque, namedtuple
+from contextlib import asynccontextmanager, nullcontext
+
+# Qt-free core shared by the GUI (sum.py) and the command line (cli.py).
+# Telethon and aiohttp are imported where they are first needed so that
+# importing this module stays cheap.
+
+CONFIG_FILE = "config.json"
+SESSION_NAME = "avatar_session"
+STORE_FILE = "messages.db"
+SNAPSHOT_FILE = "dialogs.json"
+PROXY_BASE = "https://proxy.ganstermaxtivinew.workers.dev/?url="
+GEMINI_MODEL = "gemini-flash-latest"
+DEFAULT_CONCURRENCY = 4
+HTTP_POOL_SIZE = 20
+HTTP_POOL_PER_HOST = 8
+HTTP_DNS_TTL = 300
+HTTP_KEEPALIVE = 60
+ENTITY_CACHE_SIZE = 2048
+CONTEXT_MESSAGES = 30
+STORE_RETENTION_DAYS = 30
+STORE_MAX_MESSAGES = 2000
+SUMMARY_CACHE_MAX_MB = 20
+SUMMARY_CACHE_TTL_DAYS = 14
+STORE_PAGE_SIZE = 500
+CHUNK_TOKEN_BUDGET = 30000
+CHUNK_FANOUT = 4
+LLM_CONCURRENCY = 8
+LLM_MAX_CONCURRENCY = 32
+LLM_MAX_RETRIES = 5
+LLM_MAX_WAIT = 60
+TELEGRAM_CONCURRENCY = 4
+TELEGRAM_MAX_RETRIES = 3
+FLOOD_WAIT_MAX = 300
+COMPACT_MAX_CHARS = 500
+COMPACT_MERGE_GAP = 300
+COMPACT_DEDUP_MIN_CHARS = 20
+BATCH_MAX_UNREAD = 5
+BATCH_TOKEN_BUDGET = 12000
+BATCH_MAX_CHATS = 8
+PREFETCH_MAX_DIALOGS = 20
+PREFETCH_MAX_UNREAD = 1000
+PREFETCH_CONCURRENCY = 2
+SYNC_FRESH_SECONDS = 120
+RECENT_CHATS_MAX = 50
+ROLLING_SUMMARY_CHARS = 2000
+OFFLOAD_MIN_BYTES = 64 * 1024
+OFFLOAD_MIN_MESSAGES = 200
+LOOP_STALL_MS = 100
+LOOP_MONITOR_INTERVAL = 0.02
+LOOP_STALLS_KEPT = 50
+HOT_TAIL_SIZE = 200
+SCHEDULE_BASE_SECONDS = 2.0
+SCHEDULE_TOKENS_PER_SECOND = 4000
+SCHEDULE_DEFAULT_CHARS = 80
+LATENCY_WINDOW = 200
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 10
+HEDGE_MIN_DELAY = 0.2
+HEDGE_DEFAULT_DELAY = 8.0
+BACKEND_DOWN_MAX_SECONDS = 60
+
+async def offload(func, *args):
+    # Runs CPU-bound work on the default executor so the event loop, and
+    # with it the Qt UI and Telethon's network handling, keeps running.
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+def markdown_html(text):
+    import markdown
+
+    return markdown.markdown(text, extensions=['tables', 'fenced_code'])
+
+def write_atomic(path, write):
+    # Written through a temp file and renamed, so readers never see a
+    # half-written file. `write` gets the open text file.
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def write_json_atomic(path, data, **dump_args):
+    write_atomic(path, lambda f: json.dump(data, f, **dump_args))
+
+class ConfigManager:
+    _cache = None
+    _stamp = None
+
+    @staticmethod
+    def _file_stamp():
+        try:
+            st = os.stat(CONFIG_FILE)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    @staticmethod
+    def load():
+        stamp = ConfigManager._file_stamp()
+        if ConfigManager._cache is not None and stamp == ConfigManager._stamp:
+            return dict(ConfigManager._cache)
+
+        data = {}
+        if stamp is not None:
+            try:
+                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except:
+                data = {}
+        ConfigManager._cache = data
+        ConfigManager._stamp = stamp
+        return dict(data)
+
+    @staticmethod
+    def save(data):
+        current = ConfigManager.load()
+        current.update(data)
+        write_json_atomic(CONFIG_FILE, current, indent=4)
+        ConfigManager._cache = current
+        ConfigManager._stamp = ConfigManager._file_stamp()
+
+    @staticmethod
+    def get(key):
+        stamp = ConfigManager._file_stamp()
+        if ConfigManager._cache is None or stamp != ConfigManager._stamp:
+            ConfigManager.load()
+        return ConfigManager._cache.get(key)
+
+    @staticmethod
+    def get_int(key, default, minimum=1):
+        try:
+            return max(minimum, int(ConfigManager.get(key)))
+        except (TypeError, ValueError):
+            return default
+
+    @staticmethod
+    def get_float(key, default, minimum=0.0):
+        try:
+            return max(minimum, float(ConfigManager.get(key)))
+        except (TypeError, ValueError):
+            return default
+
+class MessageRecord:
+    # The part of a message the digest uses. Telethon messages are converted
+    # while they are downloaded, so no TL objects or client references
+    # outlive the fetch loop; `date` is a Unix timestamp.
+    __slots__ = ("id", "reply_to_msg_id", "sender_id", "date", "text")
+
+    def __init__(self, id, reply_to_msg_id, sender_id, date, text):
+        self.id = id
+        self.reply_to_msg_id = reply_to_msg_id
+        self.sender_id = sender_id
+        self.date = date
+        self.text = text
+
+    def __repr__(self):
+        return (f"MessageRecord(id={self.id}, reply_to_msg_id={self.reply_to_msg_id}, "
+                f"sender_id={self.sender_id}, date={self.date}, text={self.text!r})")
+
+History = namedtuple("History", "context first_unread newest_id previous_summary")
+
+def message_record(msg):
+    return MessageRecord(msg.id, msg.reply_to_msg_id, msg.sender_id, int(msg.date.timestamp()), msg.text)
+
+class DialogRow:
+    # Compact list entry: keeps the InputPeer instead of the full Dialog.
+    __slots__ = ("id", "name", "kind", "unread_count", "entity", "checked")
+
+    KIND_ICONS = {"channel": "📢", "group": "👥", "user": "👤"}
+
+    def __init__(self, id, name, kind, unread_count, entity=None, checked=False):
+        self.id = id
+        self.name = name
+        self.kind = kind
+        self.unread_count = unread_count
+        self.entity = entity
+        self.checked = checked
+
+    @classmethod
+    def from_dialog(cls, dialog):
+        kind = "group" if dialog.is_group else "channel" if dialog.is_channel else "user"
+        return cls(dialog.id, dialog.name, kind, dialog.unread_count, dialog.input_entity)
+
+    @property
+    def label(self):
+        return f"{self.KIND_ICONS[self.kind]} {self.name} (+{self.unread_count})"
+
+def load_dialog_snapshot(path=SNAPSHOT_FILE):
+    # Rows of the last dialog list without their entities: enough to draw
+    # the list before Telegram is connected.
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return [DialogRow(dialog_id, name, kind, unread) for dialog_id, name, kind, unread in data["rows"]]
+    except (OSError, ValueError, KeyError, TypeError):
+        return []
+
+def save_dialog_snapshot(rows, path=SNAPSHOT_FILE):
+    data = {"saved": int(time.time()), "rows": [[r.id, r.name, r.kind, r.unread_count] for r in rows]}
+    write_json_atomic(path, data, ensure_ascii=False, separators=(",", ":"))
+
+class MessageStore:
+    def __init__(self, path=STORE_FILE):
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " dialog_id INTEGER NOT NULL, msg_id INTEGER NOT NULL,"
+                " reply_to INTEGER, sender_id INTEGER, date INTEGER NOT NULL, text TEXT,"
+                " PRIMARY KEY (dialog_id, msg_id)) WITHOUT ROWID"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS messages_date ON messages (date)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS rolling_summaries ("
+                " dialog_id INTEGER PRIMARY KEY, last_msg_id INTEGER NOT NULL, summary TEXT NOT NULL,"
+                " updated INTEGER NOT NULL)"
+            )
+            self.prune_expired()
+        return self._db
+
+    def max_id(self, dialog_id):
+        row = self.db.execute("SELECT MAX(msg_id) FROM messages WHERE dialog_id = ?", (dialog_id,)).fetchone()
+        return row[0] or 0
+
+    def add(self, dialog_id, records):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                [(dialog_id, r.id, r.reply_to_msg_id, r.sender_id, r.date, r.text) for r in records],
+            )
+
+    def rolling_summary(self, dialog_id):
+        # Returns (last_msg_id, summary) of the previous digest, or None.
+        return self.db.execute(
+            "SELECT last_msg_id, summary FROM rolling_summaries WHERE dialog_id = ?", (dialog_id,)
+        ).fetchone()
+
+    def save_rolling_summary(self, dialog_id, last_msg_id, summary):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO rolling_summaries VALUES (?, ?, ?, ?)",
+                (dialog_id, last_msg_id, summary, int(time.time())),
+            )
+
+    def avg_text_length(self, dialog_id, sample=200):
+        row = self.db.execute(
+            "SELECT AVG(LENGTH(text)) FROM (SELECT text FROM messages WHERE dialog_id = ?"
+            " ORDER BY msg_id DESC LIMIT ?)",
+            (dialog_id, sample),
+        ).fetchone()
+        return row[0]
+
+    def latest(self, dialog_id, count, before=None):
+        rows = self.db.execute(
+            "SELECT msg_id, reply_to, sender_id, date, text FROM messages"
+            " WHERE dialog_id = ? AND msg_id < ? ORDER BY msg_id DESC LIMIT ?",
+            (dialog_id, before if before is not None else sys.maxsize, count),
+        ).fetchall()
+        return [MessageRecord(*row) for row in reversed(rows)]
+
+    def nth_latest_id(self, dialog_id, n):
+        row = self.db.execute(
+            "SELECT msg_id FROM messages WHERE dialog_id = ? ORDER BY msg_id DESC LIMIT 1 OFFSET ?",
+            (dialog_id, n - 1),
+        ).fetchone()
+        if row is None:
+            row = self.db.execute("SELECT MIN(msg_id) FROM messages WHERE dialog_id = ?", (dialog_id,)).fetchone()
+        return row[0]
+
+    def iter_pages(self, dialog_id, first_id, page_size):
+        last_id = first_id - 1
+        while True:
+            rows = self.db.execute(
+                "SELECT msg_id, reply_to, sender_id, date, text FROM messages"
+                " WHERE dialog_id = ? AND msg_id > ? ORDER BY msg_id LIMIT ?",
+                (dialog_id, last_id, page_size),
+            ).fetchall()
+            if not rows:
+                return
+            yield [MessageRecord(*row) for row in rows]
+            last_id = rows[-1][0]
+
+    def delete_newer(self, dialog_id, msg_id):
+        with self.db:
+            self.db.execute("DELETE FROM messages WHERE dialog_id = ? AND msg_id > ?", (dialog_id, msg_id))
+
+    def prune(self, dialog_id, keep):
+        with self.db:
+            self.db.execute(
+                "DELETE FROM messages WHERE dialog_id = ? AND msg_id < ("
+                " SELECT msg_id FROM messages WHERE dialog_id = ? ORDER BY msg_id DESC LIMIT 1 OFFSET ?)",
+                (dialog_id, dialog_id, keep - 1),
+            )
+
+    def prune_expired(self):
+        # Drops dialogs with no message newer than the retention period.
+        # Delta syncs only download above the newest stored id, so removing
+        # just the old rows of a dialog would cut its backlog short for good.
+        days = ConfigManager.get_int("store_retention_days", STORE_RETENTION_DAYS)
+        with self._db:
+            self._db.execute(
+                "DELETE FROM messages WHERE dialog_id IN ("
+                " SELECT dialog_id FROM messages GROUP BY dialog_id HAVING MAX(date) < ?)",
+                (int(time.time()) - days * 86400,),
+            )
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+class SummaryCache:
+    def __init__(self, path=STORE_FILE):
+        self.path = path
+        self._db = None
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS summaries ("
+                " key TEXT PRIMARY KEY, summary TEXT NOT NULL, size INTEGER NOT NULL,"
+                " latency REAL NOT NULL, created INTEGER NOT NULL, accessed INTEGER NOT NULL)"
+            )
+        return self._db
+
+    @staticmethod
+    def make_key(model, prompt):
+        return hashlib.sha256(f"{model}\n{prompt}".encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        ttl = ConfigManager.get_int("summary_cache_ttl_days", SUMMARY_CACHE_TTL_DAYS) * 86400
+        row = self.db.execute(
+            "SELECT summary, latency FROM summaries WHERE key = ? AND created >= ?",
+            (key, int(time.time()) - ttl),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        with self.db:
+            self.db.execute("UPDATE summaries SET accessed = ? WHERE key = ?", (int(time.time()), key))
+        self.hits += 1
+        self.saved_seconds += row[1]
+        return row[0]
+
+    def put(self, key, summary, latency):
+        now = int(time.time())
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?, ?)",
+                (key, summary, len(summary.encode('utf-8')), latency, now, now),
+            )
+        self.evict()
+
+    def evict(self):
+        ttl = ConfigManager.get_int("summary_cache_ttl_days", SUMMARY_CACHE_TTL_DAYS) * 86400
+        max_bytes = ConfigManager.get_int("summary_cache_max_mb", SUMMARY_CACHE_MAX_MB) * 1024 * 1024
+        with self.db:
+            self.db.execute("DELETE FROM summaries WHERE created < ?", (int(time.time()) - ttl,))
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM summaries").fetchone()[0]
+            if total <= max_bytes:
+                return
+            doomed = []
+            for key, size in self.db.execute("SELECT key, size FROM summaries ORDER BY accessed"):
+                if total <= max_bytes:
+                    break
+                doomed.append((key,))
+                total -= size
+            self.db.executemany("DELETE FROM summaries WHERE key = ?", doomed)
+
+    def summary(self):
+        return f"Cache: {self.hits} hits / {self.misses} misses, ~{self.saved_seconds:.0f}s LLM time saved"
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+def sender_display_name(entity):
+    return getattr(entity, 'first_name', None) or getattr(entity, 'title', None) or 'Unknown'
+
+def format_message_line(msg, name):
+    content = msg.text or "[Media/Sticker]"
+    meta = f"[ID:{msg.id}]"
+    if msg.reply_to_msg_id:
+        meta += f" [ReplyTo:{msg.reply_to_msg_id}]"
+    return f"{meta} {name}: {content}"
+
+def format_lines(messages, sender_names):
+    return [format_message_line(msg, sender_names.get(msg.sender_id, 'Unknown')) for msg in messages]
+
+def estimate_tokens(text):
+    # Rough heuristic (~4 characters per token); good enough for budgeting.
+    return len(text) // 4 + 1
+
+VERBOSE_FORMAT_NOTE = (
+    "Messages have format '[ID:...] [ReplyTo:...] Name: Text'. "
+    "Use ReplyTo to understand who is replying to whom. "
+)
+COMPACT_FORMAT_NOTE = (
+    "Messages have format '#N>M A: Text'. N is the message number, >M means a reply to message M "
+    "(>? is a reply to an older message that is not shown), A is a sender alias from the Senders list. "
+    "'#N-K' are consecutive messages of one sender separated by ' / '; '(=#M)' repeats the text of message M. "
+    "Use >M to understand who is replying to whom. "
+)
+URL_ONLY = re.compile(r"^\s*(https?://\S+)\s*$")
+
+class PromptEncoder:
+    # Compact message encoding for one dialog: batch-relative message
+    # numbers, short sender aliases with a legend, merged runs of one
+    # sender, and collapsed duplicate, link-only and overlong texts. One
+    # encoder is used for the context and every page of a chat so numbers
+    # and aliases stay consistent across chunks. Repeated texts and reply
+    # marks only point back within the current chunk (see start_chunk).
+
+    def __init__(self, max_chars=COMPACT_MAX_CHARS, merge_gap=COMPACT_MERGE_GAP):
+        self.max_chars = max_chars
+        self.merge_gap = merge_gap
+        self.aliases = {}
+        self.legend_names = {}
+        self.numbers = {}
+        self.texts = {}
+        self.next_number = 1
+        self.chunk_start = 1
+        self.run_sizes = []
+        self.verbose_tokens = 0
+        self.compact_tokens = 0
+
+    def start_chunk(self):
+        # Messages encoded from here on go into a prompt of their own, which
+        # does not show the earlier ones.
+        self.texts = {}
+        self.chunk_start = self.next_number
+
+    def mark(self):
+        return self.next_number, self.verbose_tokens, self.compact_tokens
+
+    def rewind(self, mark, messages):
+        # Undoes encoding `messages` since `mark`, so they can be encoded
+        # again, e.g. into the next chunk.
+        self.next_number, self.verbose_tokens, self.compact_tokens = mark
+        for msg in messages:
+            self.numbers.pop(msg.id, None)
+        self.texts = {text: number for text, number in self.texts.items() if number < self.next_number}
+
+    def alias(self, sender_id, name):
+        alias = self.aliases.get(sender_id)
+        if alias is None:
+            i = len(self.aliases)
+            alias = chr(ord('A') + i % 26) + (str(i // 26) if i >= 26 else "")
+            self.aliases[sender_id] = alias
+            self.legend_names[alias] = name
+        return alias
+
+    def legend(self):
+        return "Senders: " + ", ".join(f"{alias}={name}" for alias, name in self.legend_names.items())
+
+    def _content(self, msg, number):
+        text = msg.text
+        if not text:
+            return "[media]"
+        link = URL_ONLY.match(text)
+        if link:
+            return f"[link {urllib.parse.urlsplit(link.group(1)).netloc}]"
+        text = " ".join(text.split())
+        if len(text) >= COMPACT_DEDUP_MIN_CHARS:
+            earlier = self.texts.setdefault(text, number)
+            if earlier != number:
+                return f"(=#{earlier})"
+        if len(text) > self.max_chars:
+            text = f"{text[:self.max_chars]}…[+{len(text) - self.max_chars} chars]"
+        return text
+
+    def encode(self, messages, sender_names):
+        # run_sizes is set to the number of messages in each returned line.
+        lines = []
+        self.run_sizes = []
+        run = None  # [first number, last number, reply mark, alias, texts, last date]
+
+        def close_run():
+            first, last, reply, alias, texts, _ = run
+            numbers = f"#{first}" if first == last else f"#{first}-{last}"
+            lines.append(f"{numbers}{reply} {alias}: {' / '.join(texts)}")
+            self.run_sizes.append(last - first + 1)
+
+        for msg in messages:
+            name = sender_names.get(msg.sender_id, 'Unknown')
+            self.verbose_tokens += estimate_tokens(format_message_line(msg, name))
+            number = self.next_number
+            self.next_number += 1
+            self.numbers[msg.id] = number
+            alias = self.alias(msg.sender_id, name)
+            content = self._content(msg, number)
+
+            reply = ""
+            if msg.reply_to_msg_id:
+                target = self.numbers.get(msg.reply_to_msg_id)
+                reply = f">{target}" if target and target >= self.chunk_start else ">?"
+
+            if run and not reply and run[3] == alias and msg.date - run[5] <= self.merge_gap:
+                run[1] = number
+                run[4].append(content)
+                run[5] = msg.date
+                continue
+            if run:
+                close_run()
+            run = [number, number, reply, alias, [content], msg.date]
+        if run:
+            close_run()
+
+        self.compact_tokens += sum(estimate_tokens(line) for line in lines)
+        return lines
+
+def build_prompt(chat_name, context_str, new_str, legend=None):
+    format_note = VERBOSE_FORMAT_NOTE if legend is None else COMPACT_FORMAT_NOTE
+    legend_part = f"{legend}\n" if legend else ""
+    return (
+        f"Role: Personal Assistant. Analyze the correspondence in chat '{chat_name}'.\n"
+        f"IMPORTANT: {format_note}"
+        f"IMPORTANT: Answer in main language of chat messages.\n\n"
+        f"{legend_part}"
+        f"--- CONTEXT (already read) ---\n{context_str}\n"
+        f"================================\n"
+        f"--- NEW MESSAGES (summarize these) ---\n{new_str}\n\n"
+        f"TASK: Write a brief summary of the NEW messages."
+    )
+
+def rolling_context(previous_summary):
+    # Stands in for the already-read messages when the chat was summarized
+    # before.
+    return f"(Summary of the earlier messages, from the previous digest)\n{previous_summary}"
+
+def build_chunk_prompt(chat_name, part, context_str, chunk_str, legend=None):
+    format_note = VERBOSE_FORMAT_NOTE if legend is None else COMPACT_FORMAT_NOTE
+    legend_part = f"{legend}\n" if legend else ""
+    context_part = f"--- CONTEXT (already read) ---\n{context_str}\n================================\n" if context_str else ""
+    return (
+        f"Role: Personal Assistant. Analyze part {part} of the new messages in chat '{chat_name}'.\n"
+        f"IMPORTANT: {format_note}"
+        f"IMPORTANT: Answer in main language of chat messages.\n\n"
+        f"{legend_part}"
+        f"{context_part}"
+        f"--- NEW MESSAGES, PART {part} (summarize these) ---\n{chunk_str}\n\n"
+        f"TASK: Write a brief summary of this part. Keep names, decisions and open questions."
+    )
+
+def build_reduce_prompt(chat_name, partial_summaries):
+    parts = "\n\n".join(f"--- PART {i} ---\n{text}" for i, text in enumerate(partial_summaries, start=1))
+    return (
+        f"Role: Personal Assistant. Below are summaries of consecutive parts of the new messages in chat '{chat_name}'.\n"
+        f"IMPORTANT: Answer in main language of the summaries.\n\n"
+        f"{parts}\n\n"
+        f"TASK: Merge them into one brief summary of the NEW messages. Remove repetitions."
+    )
+
+BatchItem = namedtuple("BatchItem", "idx dialog context_str new_str legend history")
+# Exactly the '### CHAT N' line the batch prompt asks for, optionally
+# followed by the chat name ("### CHAT 2: 'Team'"), so that a summary line
+# such as "Chat 2 was moved" does not start a new section.
+BATCH_HEADER = re.compile(r"^### CHAT (\d+)(?:[ \t]*[:\-–—][^\n]*)?[ \t]*$", re.MULTILINE)
+
+def build_batch_prompt(items):
+    compact = items[0].legend is not None
+    format_note = COMPACT_FORMAT_NOTE + "Message numbers and aliases are local to each chat. " if compact else VERBOSE_FORMAT_NOTE
+    sections = []
+    for number, item in enumerate(items, start=1):
+        legend_part = f"{item.legend}\n" if item.legend else ""
+        context_part = f"--- CONTEXT (already read) ---\n{item.context_str}\n" if item.context_str else ""
+        sections.append(
+            f"=== CHAT {number}: '{item.dialog.name}' ===\n"
+            f"{legend_part}"
+            f"{context_part}"
+            f"--- NEW MESSAGES (summarize these) ---\n{item.new_str}\n"
+        )
+    return (
+        f"Role: Personal Assistant. Analyze the correspondence in {len(items)} separate chats.\n"
+        f"IMPORTANT: {format_note}"
+        f"IMPORTANT: Answer in main language of each chat's messages.\n\n"
+        + "\n".join(sections) +
+        "\nTASK: For every chat write a brief summary of its NEW messages. "
+        "Start each summary with a separate line '### CHAT N', where N is the chat number, "
+        "keep the chats in order and never mix messages of different chats."
+    )
+
+def split_batch_response(text, count):
+    # Returns one summary per chat of a batch; None where the answer has no
+    # usable section for that chat.
+    sections = [None] * count
+    matches = list(BATCH_HEADER.finditer(text or ""))
+    for match, following in zip(matches, matches[1:] + [None]):
+        number = int(match.group(1))
+        body = text[match.end():following.start() if following else len(text)].strip()
+        if 1 <= number <= count and body and sections[number - 1] is None:
+            sections[number - 1] = body
+    return sections
+
+class _Span:
+    __slots__ = ("metrics", "stage", "dialog_id", "started")
+
+    def __init__(self, metrics, stage, dialog_id):
+        self.metrics = metrics
+        self.stage = stage
+        self.dialog_id = dialog_id
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.records.append((self.stage, self.dialog_id, self.started, time.perf_counter() - self.started))
+
+class Metrics:
+    STAGES = ("history", "senders", "prompt", "llm", "render")
+    _OFF = nullcontext()
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.records = []
+        self.run_started = time.time()
+        # Seconds from process start to each startup milestone; kept across
+        # runs and written to the first export after they are recorded.
+        self.startup = {}
+        self._startup_exported = set()
+
+    def span(self, stage, dialog_id=None):
+        # Disabled metrics hand out one shared no-op context manager, so an
+        # instrumented call costs a single attribute check.
+        if not self.enabled:
+            return self._OFF
+        return _Span(self, stage, dialog_id)
+
+    def reset(self):
+        self.records = []
+        self.run_started = time.time()
+
+    def stage_stats(self):
+        durations = {}
+        for stage, _, _, duration in self.records:
+            durations.setdefault(stage, []).append(duration)
+        stats = {}
+        for stage in sorted(durations, key=lambda s: self.STAGES.index(s) if s in self.STAGES else len(self.STAGES)):
+            values = sorted(durations[stage])
+            stats[stage] = {
+                "count": len(values),
+                "total": sum(values),
+                "mean": sum(values) / len(values),
+                "p50": values[len(values) // 2],
+                "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+                "max": values[-1],
+            }
+        return stats
+
+    def mark_startup(self, name, seconds):
+        self.startup.setdefault(name, seconds)
+
+    def summary_table(self):
+        lines = [f"{'stage':<10}{'count':>7}{'total s':>10}{'mean ms':>10}{'p95 ms':>10}{'max ms':>10}"]
+        for stage, st in self.stage_stats().items():
+            lines.append(
+                f"{stage:<10}{st['count']:>7}{st['total']:>10.2f}{st['mean'] * 1000:>10.1f}"
+                f"{st['p95'] * 1000:>10.1f}{st['max'] * 1000:>10.1f}"
+            )
+        return "\n".join(lines)
+
+    def export(self, path):
+        if path.endswith(".prom"):
+            self.export_prometheus(path)
+        else:
+            self.export_jsonl(path)
+
+    def export_jsonl(self, path):
+        with open(path, 'a', encoding='utf-8') as f:
+            for stage, dialog_id, started, duration in self.records:
+                f.write(json.dumps({
+                    "run": self.run_started, "stage": stage, "dialog_id": dialog_id,
+                    "offset": started - self.records[0][2], "seconds": duration,
+                }) + "\n")
+            for name, seconds in self.startup.items():
+                if name not in self._startup_exported:
+                    f.write(json.dumps({"run": self.run_started, "startup": name, "seconds": seconds}) + "\n")
+                    self._startup_exported.add(name)
+
+    def export_prometheus(self, path):
+        lines = [
+            "# HELP tgsum_stage_seconds Time spent in each digest stage during the last run.",
+            "# TYPE tgsum_stage_seconds summary",
+        ]
+        for stage, st in self.stage_stats().items():
+            lines.append(f'tgsum_stage_seconds{{stage="{stage}",quantile="0.5"}} {st["p50"]:.6f}')
+            lines.append(f'tgsum_stage_seconds{{stage="{stage}",quantile="0.95"}} {st["p95"]:.6f}')
+            lines.append(f'tgsum_stage_seconds_sum{{stage="{stage}"}} {st["total"]:.6f}')
+            lines.append(f'tgsum_stage_seconds_count{{stage="{stage}"}} {st["count"]}')
+        lines.append(f"tgsum_last_run_timestamp_seconds {self.run_started:.0f}")
+        if self.startup:
+            lines.append("# HELP tgsum_startup_seconds Seconds from process start to each startup milestone.")
+            lines.append("# TYPE tgsum_startup_seconds gauge")
+            for name, seconds in self.startup.items():
+                lines.append(f'tgsum_startup_seconds{{phase="{name}"}} {seconds:.6f}')
+        text = "\n".join(lines) + "\n"
+        write_atomic(path, lambda f: f.write(text))
+
+class RateLimitedError(Exception):
+    def __init__(self, retry_after=None, message="rate limited"):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class ChatSkipped(Exception):
+    def __init__(self, message="not started: the time budget is almost used up"):
+        super().__init__(message)
+
+class SummaryError(Exception):
+    # The model could not summarize a chat; the message is the error text
+    # from request_summary.
+    pass
+
+def parse_retry_after(header, body=None):
+    # Seconds to wait from a Retry-After header (seconds or HTTP date) or
+    # from a Google RetryInfo detail such as {"retryDelay": "12s"}.
+    if header:
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(header).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    if isinstance(body, dict):
+        for detail in body.get('error', {}).get('details', []):
+            delay = str(detail.get('retryDelay', ''))
+            if delay.endswith('s'):
+                try:
+                    return float(delay[:-1])
+                except ValueError:
+                    pass
+    return None
+
+class AdaptiveLimiter:
+    # AIMD concurrency limit with jittered exponential backoff: every success
+    # adds 1/limit (about +1 per round of requests), a throttle halves the
+    # limit (at most once per second) and pauses new requests for the
+    # server-requested delay.
+
+    def __init__(self, name, initial, minimum=1, maximum=LLM_MAX_CONCURRENCY):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.retries = 0
+        self.throttled = 0
+        self._last_decrease = 0.0
+        self._released = None
+
+    async def acquire(self):
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return
+            if self._released is None:
+                self._released = asyncio.Event()
+            await self._released.wait()
+
+    def release(self):
+        self.in_flight -= 1
+        if self._released is not None:
+            self._released.set()
+            self._released = None
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_throttle(self, retry_after=None):
+        self.throttled += 1
+        now = time.monotonic()
+        if now - self._last_decrease >= 1.0:
+            self.limit = max(self.minimum, self.limit / 2)
+            self._last_decrease = now
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+
+    @staticmethod
+    def backoff(attempt, retry_after=None, base=1.0, cap=60.0):
+        jittered = random.uniform(0, min(cap, base * 2 ** attempt))
+        if retry_after is not None:
+            return retry_after + jittered * 0.1
+        return jittered
+
+    async def run(self, call, max_retries, max_wait=None):
+        attempt = 0
+        while True:
+            # A pause longer than max_wait fails at once, like a longer
+            # server-requested delay would.
+            paused = self.paused_until - time.monotonic()
+            if max_wait is not None and paused > max_wait:
+                raise RateLimitedError(paused, f"{self.name}: rate limited")
+            await self.acquire()
+            try:
+                result = await call()
+            except RateLimitedError as e:
+                self.release()
+                self.on_throttle(e.retry_after)
+                too_long = max_wait is not None and e.retry_after is not None and e.retry_after > max_wait
+                if attempt >= max_retries or too_long:
+                    raise
+                self.retries += 1
+                await asyncio.sleep(self.backoff(attempt, e.retry_after))
+                attempt += 1
+                continue
+            except BaseException:
+                self.release()
+                raise
+            self.release()
+            self.on_success()
+            return result
+
+    def summary(self):
+        return f"{self.name}: limit {self.limit:.1f}, {self.throttled} throttled, {self.retries} retries"
+
+class LoopMonitor:
+    # Measures event loop lag with a heartbeat coroutine. A watchdog thread
+    # notices when the heartbeat is late by more than the threshold and
+    # samples the loop thread's stack, so each stall is reported together
+    # with the code that was blocking the loop.
+    def __init__(self, threshold_ms=None, interval=LOOP_MONITOR_INTERVAL):
+        self.threshold = (threshold_ms or ConfigManager.get_int("loop_stall_ms", LOOP_STALL_MS)) / 1000
+        self.interval = interval
+        self.lags = deque(maxlen=4096)
+        self.stalls = deque(maxlen=LOOP_STALLS_KEPT)
+        self.stall_count = 0
+        self._beat = None
+        self._sample = None
+        self._loop_thread = None
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        # Must be called from the loop's thread.
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-monitor", daemon=True)
+        self._thread.start()
+        return self
+
+    async def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.lags.append(lag)
+            sample, self._sample = self._sample, None
+            if lag >= self.threshold:
+                self.stall_count += 1
+                self.stalls.append((time.time() - lag, lag, sample or ("(not sampled)",)))
+            self._beat = now
+
+    def _watch(self):
+        while not self._stop.wait(self.interval / 2):
+            late = time.monotonic() - self._beat - self.interval
+            if late < self.threshold or self._sample is not None:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                self._sample = tuple(
+                    f"{os.path.basename(f.filename)}:{f.lineno} {f.name}" for f in traceback.extract_stack(frame)[-6:]
+                )
+
+    def stats(self):
+        lags = sorted(self.lags)
+        if not lags:
+            return {"samples": 0, "stalls": self.stall_count}
+        return {
+            "samples": len(lags),
+            "p50_ms": lags[len(lags) // 2] * 1000,
+            "p95_ms": lags[min(len(lags) - 1, int(len(lags) * 0.95))] * 1000,
+            "max_ms": lags[-1] * 1000,
+            "stalls": self.stall_count,
+            "threshold_ms": self.threshold * 1000,
+        }
+
+    def summary(self):
+        st = self.stats()
+        if not st["samples"]:
+            return "Loop lag: no samples"
+        return (f"Loop lag: p95 {st['p95_ms']:.0f} ms, max {st['max_ms']:.0f} ms, "
+                f"{st['stalls']} stalls > {st['threshold_ms']:.0f} ms")
+
+    def report(self):
+        # One line per recorded stall, innermost frame first.
+        lines = []
+        for started, lag, stack in self.stalls:
+            at = time.strftime("%H:%M:%S", time.localtime(started))
+            lines.append(f"{lag * 1000:6.0f} ms at {at} in " + " < ".join(reversed(stack)))
+        return "\n".join(lines)
+
+class HttpStats:
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.total_latency = 0.0
+        self.last_latency = 0.0
+
+    def trace_config(self):
+        import aiohttp
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self._on_request_start)
+        trace.on_request_end.append(self._on_request_end)
+        trace.on_connection_create_end.append(self._on_connection_create)
+        trace.on_connection_reuseconn.append(self._on_connection_reuse)
+        return trace
+
+    async def _on_request_start(self, session, ctx, params):
+        ctx.started = time.perf_counter()
+
+    async def _on_request_end(self, session, ctx, params):
+        self.last_latency = time.perf_counter() - ctx.started
+        self.total_latency += self.last_latency
+        self.requests += 1
+
+    async def _on_connection_create(self, session, ctx, params):
+        self.new_connections += 1
+
+    async def _on_connection_reuse(self, session, ctx, params):
+        self.reused_connections += 1
+
+    def summary(self):
+        if not self.requests:
+            return "HTTP: no requests"
+        avg_ms = self.total_latency / self.requests * 1000
+        return (f"HTTP: {self.requests} req, avg {avg_ms:.0f} ms, "
+                f"{self.new_connections} new / {self.reused_connections} reused connections")
+
+class LatencyHistogram:
+    # Log-spaced buckets 25% apart, from 50 ms up to about two minutes.
+    # Counts are halved whenever they add up to LATENCY_WINDOW, so the
+    # percentiles follow a backend's recent latency rather than the whole
+    # session's.
+    FIRST = 0.05
+    RATIO = 1.25
+    BUCKETS = 36
+
+    def __init__(self):
+        self.counts = [0.0] * self.BUCKETS
+        self.weight = 0.0
+        self.samples = 0
+
+    def add(self, seconds):
+        bucket = 0
+        if seconds > self.FIRST:
+            bucket = min(self.BUCKETS - 1, math.ceil(math.log(seconds / self.FIRST, self.RATIO)))
+        self.counts[bucket] += 1
+        self.weight += 1
+        self.samples += 1
+        if self.weight >= LATENCY_WINDOW:
+            self.counts = [count / 2 for count in self.counts]
+            self.weight /= 2
+
+    def percentile(self, pct):
+        # Upper bound of the bucket holding the percentile, None when empty.
+        if not self.weight:
+            return None
+        wanted = self.weight * pct / 100
+        seen = 0.0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return self.FIRST * self.RATIO ** bucket
+        return self.FIRST * self.RATIO ** (self.BUCKETS - 1)
+
+class LLMBackend:
+    # One endpoint that answers summary prompts. Subclasses build the request
+    # and read the reply; the worker owns the HTTP session, retries, hedging
+    # and the cache. Every backend has its own AIMD limiter so a throttled
+    # endpoint does not hold back the others.
+    BLOCKED = "⚠️ Content blocked"
+    # Every refusal (a block or a safety stop) starts with this.
+    REFUSED = "⚠️"
+    NO_TEXT = "AI returned no text."
+
+    def __init__(self, name, model):
+        self.name = name
+        self.model = model
+        self.latency = LatencyHistogram()
+        self.limiter = AdaptiveLimiter(
+            name, ConfigManager.get_int("llm_concurrency", LLM_CONCURRENCY),
+            maximum=ConfigManager.get_int("llm_max_concurrency", LLM_MAX_CONCURRENCY),
+        )
+        self.failures = 0
+        self.failure_streak = 0
+        self.down_until = 0.0
+
+    def url(self, stream):
+        raise NotImplementedError
+
+    def headers(self):
+        return {'Content-Type': 'application/json'}
+
+    def payload(self, system, text, stream):
+        raise NotImplementedError
+
+    def reply_text(self, result):
+        # Returns (text, error) for a complete JSON reply.
+        raise NotImplementedError
+
+    def event_text(self, event):
+        # Returns (text, error) for one streamed event; text is the new part.
+        return self.reply_text(event)
+
+    def is_down(self):
+        return time.monotonic() < self.down_until
+
+    def typical_latency(self):
+        if self.latency.samples < HEDGE_MIN_SAMPLES:
+            return None
+        return self.latency.percentile(50)
+
+    def hedge_delay(self):
+        if self.latency.samples < HEDGE_MIN_SAMPLES:
+            return ConfigManager.get_float("hedge_delay", HEDGE_DEFAULT_DELAY, minimum=HEDGE_MIN_DELAY)
+        pct = ConfigManager.get_int("hedge_percentile", HEDGE_PERCENTILE)
+        return max(HEDGE_MIN_DELAY, self.latency.percentile(min(pct, 100)))
+
+    def on_success(self, seconds):
+        self.latency.add(seconds)
+        self.failure_streak = 0
+
+    def on_failure(self, retry_after=None):
+        # Connection errors and exhausted retries take the backend out of
+        # routing for 2, 4, 8... seconds, or until its Retry-After is over.
+        self.failures += 1
+        self.failure_streak += 1
+        pause = min(BACKEND_DOWN_MAX_SECONDS, 2 ** self.failure_streak)
+        self.down_until = time.monotonic() + max(pause, retry_after or 0)
+
+    def summary(self):
+        p50, p95 = self.latency.percentile(50), self.latency.percentile(95)
+        if p50 is None:
+            return f"{self.name}: no answers, {self.failures} failed"
+        return f"{self.name}: p50 {p50:.2f}s, p95 {p95:.2f}s over {self.latency.samples} req, {self.failures} failed"
+
+class GeminiBackend(LLMBackend):
+    # Google's generateContent API, directly or wrapped in a `?url=` proxy.
+    API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+
+    def __init__(self, name, key, model=GEMINI_MODEL, proxy_base=None, api_base=API_BASE):
+        super().__init__(name, model)
+        self.key = key
+        self.proxy_base = proxy_base
+        self.api_base = api_base.rstrip("/")
+
+    def url(self, stream):
+        if stream:
+            url = f"{self.api_base}/models/{self.model}:streamGenerateContent?alt=sse&key={self.key}"
+        else:
+            url = f"{self.api_base}/models/{self.model}:generateContent?key={self.key}"
+        if self.proxy_base:
+            return f"{self.proxy_base}{urllib.parse.quote(url, safe='')}"
+        return url
+
+    def payload(self, system, text, stream):
+        safety_settings = [
+            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
+        ]
+        return {
+            "contents": [{"parts": [{"text": system + "\n\n" + text}]}],
+            "safetySettings": safety_settings
+        }
+
+    def reply_text(self, result):
+        if 'promptFeedback' in result:
+            pf = result['promptFeedback']
+            if pf.get('blockReason') and pf['blockReason'] != 'BLOCK_REASON_UNSPECIFIED':
+                return None, f"{self.BLOCKED} by Google (Hard Block): {pf['blockReason']}"
+        try:
+            return result['candidates'][0]['content']['parts'][0]['text'], None
+        except (KeyError, IndexError):
+            if result.get('candidates') and result['candidates'][0].get('finishReason') == 'SAFETY':
+                return None, "⚠️ Google hid the response due to safety settings (Safety Filter)."
+            return None, self.NO_TEXT
+
+    def event_text(self, event):
+        # A stream cut by the safety filter may carry a last piece of text
+        # along with the stop; the answer is incomplete either way.
+        candidates = event.get('candidates') or [{}]
+        if candidates[0].get('finishReason') == 'SAFETY':
+            return None, "⚠️ Google hid the response due to safety settings (Safety Filter)."
+        return self.reply_text(event)
+
+class OpenAIBackend(LLMBackend):
+    # Any server with an OpenAI-compatible /chat/completions endpoint
+    # (llama.cpp, vLLM, Ollama, LM Studio, hosted APIs).
+
+    def __init__(self, name, api_base, model, key=None):
+        super().__init__(name, model)
+        self.api_base = api_base.rstrip("/")
+        self.key = key
+
+    def url(self, stream):
+        return f"{self.api_base}/chat/completions"
+
+    def headers(self):
+        headers = super().headers()
+        if self.key:
+            headers['Authorization'] = f"Bearer {self.key}"
+        return headers
+
+    def payload(self, system, text, stream):
+        return {
+            "model": self.model,
+            "messages": [{"role": "system", "content": system}, {"role": "user", "content": text}],
+            "stream": stream,
+        }
+
+    def reply_text(self, result):
+        try:
+            choice = result['choices'][0]
+        except (KeyError, IndexError, TypeError):
+            return None, self.NO_TEXT
+        if choice.get('finish_reason') == 'content_filter':
+            return None, f"{self.BLOCKED} by {self.name} (content filter)"
+        text = (choice.get('message') or choice.get('delta') or {}).get('content')
+        if not text and 'delta' not in choice:
+            return None, self.NO_TEXT
+        return text, None
+
+def build_llm_backends(config):
+    # Backends from the `llm_backends` config list, in order of preference:
+    #   {"type": "gemini", "name": "proxy", "proxy": true}
+    #   {"type": "gemini", "name": "direct", "key": "...", "model": "..."}
+    #   {"type": "openai", "name": "local", "url": "http://127.0.0.1:8080/v1", "model": "..."}
+    # Without the list there is a single Gemini backend behind proxy_base.
+    # Entries with an unknown type or without a key are skipped.
+    proxy_base = config.get("proxy_base") or PROXY_BASE
+    specs = config.get("llm_backends")
+    if not isinstance(specs, list) or not specs:
+        specs = [{"type": "gemini", "name": "gemini", "proxy": True}]
+
+    backends = []
+    for number, spec in enumerate(specs):
+        if not isinstance(spec, dict):
+            continue
+        kind = spec.get("type", "gemini")
+        name = spec.get("name") or f"{kind}-{number}"
+        if kind == "gemini":
+            key = spec.get("key") or config.get("gemini_key")
+            if not key:
+                continue
+            proxy = spec.get("proxy")
+            backends.append(GeminiBackend(
+                name, key, spec.get("model") or GEMINI_MODEL,
+                proxy_base=proxy if isinstance(proxy, str) else proxy_base if proxy else None,
+                api_base=spec.get("url") or GeminiBackend.API_BASE,
+            ))
+        elif kind == "openai" and spec.get("url") and spec.get("model"):
+            backends.append(OpenAIBackend(name, spec["url"], spec["model"], spec.get("key")))
+    return backends
+
+def rank_backends(backends):
+    # Healthy backends first, then by measured median latency; backends
+    # with too few answers keep their config order after the measured ones.
+    def key(item):
+        number, backend = item
+        typical = backend.typical_latency()
+        return (backend.is_down(), typical is None, typical or 0.0, number)
+    return [backend for _, backend in sorted(enumerate(backends), key=key)]
+
+class TelegramWorker:
+    def __init__(self):
+        self.client = None
+        self.phone = None
+        self.phone_code_hash = None
+        self.http_session = None
+        self.http_stats = HttpStats()
+        self.sender_names = OrderedDict()
+        self.sync_locks = {}
+        self.synced = {}
+        self.live = None
+        self.store = MessageStore()
+        self.summary_cache = SummaryCache()
+        self.metrics = Metrics(enabled=bool(ConfigManager.get("metrics")))
+        self.prompt_tokens_verbose = 0
+        self.prompt_tokens_compact = 0
+        self.batch_requests = 0
+        self.batched_chats = 0
+        self.llm_backends = []
+        self._backends_key = None
+        self.hedged_requests = 0
+        self.hedges_won = 0
+        self.telegram_limiter = AdaptiveLimiter(
+            "Telegram", ConfigManager.get_int("telegram_concurrency", TELEGRAM_CONCURRENCY),
+            maximum=ConfigManager.get_int("telegram_concurrency", TELEGRAM_CONCURRENCY),
+        )
+
+    def init_client(self):
+        api_id = ConfigManager.get("api_id")
+        api_hash = ConfigManager.get("api_hash")
+        if api_id and api_hash:
+            from telethon import TelegramClient
+
+            self.client = TelegramClient(SESSION_NAME, int(api_id), api_hash)
+            return True
+        return False
+
+    async def connect_and_check_auth(self):
+        if not self.client:
+            if not self.init_client():
+                return False
+        
+        await self.client.connect()
+        return await self.client.is_user_authorized()
+
+    async def send_code(self, phone):
+        self.phone = phone
+        try:
+            sent = await self.client.send_code_request(phone)
+            self.phone_code_hash = sent.phone_code_hash
+            return True, "Code sent!"
+        except Exception as e:
+            return False, str(e)
+
+    async def sign_in(self, code, password=None):
+        from telethon import errors
+
+        try:
+            if password:
+                await self.client.sign_in(password=password)
+            else:
+                await self.client.sign_in(self.phone, code, phone_code_hash=self.phone_code_hash)
+            return True, "Successful login!"
+        except errors.SessionPasswordNeededError:
+            return False, "2FA_REQUIRED"
+        except Exception as e:
+            return False, str(e)
+
+    async def iter_dialog_rows(self, limit=120):
+        async for dialog in self.client.iter_dialogs(limit=limit, archived=False):
+            yield DialogRow.from_dialog(dialog)
+
+    async def sync_history(self, dialog, limit):
+        # Only messages newer than the newest stored one are downloaded; if
+        # more than `limit` arrived since, the older part of that gap is never
+        # needed because reads below only look at the newest `limit` rows.
+        lock = self.sync_locks.setdefault(dialog.id, asyncio.Lock())
+        async with lock:
+            # With live updates on, a dialog synced once stays complete and
+            # needs no download at all.
+            if self.live is not None and self.live.covers(dialog.id, limit):
+                return
+            # A sync with the same limit that finished moments ago (usually
+            # the background prefetch) is reused instead of repeated.
+            synced = self.synced.get(dialog.id)
+            fresh = ConfigManager.get_int("sync_fresh_seconds", SYNC_FRESH_SECONDS, minimum=0)
+            if synced is not None and synced[0] >= limit and time.monotonic() - synced[1] < fresh:
+                return
+            try:
+                await self._sync_history(dialog, limit)
+            except BaseException:
+                if self.live is not None:
+                    self.live.forget(dialog.id)
+                raise
+            self.synced[dialog.id] = (limit, time.monotonic())
+            if self.live is not None:
+                self.live.mark_synced(dialog.id, limit)
+
+    async def _sync_history(self, dialog, limit):
+        from telethon import errors
+
+        since = self.store.max_id(dialog.id)
+        fetched, offset_id = 0, 0
+
+        async def fetch():
+            # Pages are stored newest first; after a FloodWait the download
+            # resumes below the oldest stored message instead of restarting.
+            records = []
+            cache_size = ConfigManager.get_int("entity_cache_size", ENTITY_CACHE_SIZE)
+
+            def flush():
+                nonlocal fetched, offset_id, records
+                if records:
+                    self.store.add(dialog.id, records)
+                    fetched += len(records)
+                    offset_id = records[-1].id
+                    records = []
+
+            try:
+                async for msg in self.client.iter_messages(
+                    dialog.entity, limit=limit - fetched, min_id=since, offset_id=offset_id
+                ):
+                    if msg.sender is not None and msg.sender_id is not None:
+                        self._remember_sender(msg.sender_id, msg.sender, cache_size)
+                    records.append(message_record(msg))
+                    if len(records) >= STORE_PAGE_SIZE:
+                        flush()
+            except errors.FloodWaitError as e:
+                flush()
+                raise RateLimitedError(e.seconds, str(e))
+            flush()
+
+        try:
+            await self.telegram_limiter.run(
+                fetch, ConfigManager.get_int("telegram_max_retries", TELEGRAM_MAX_RETRIES, minimum=0),
+                max_wait=ConfigManager.get_int("flood_wait_max", FLOOD_WAIT_MAX),
+            )
+        except BaseException:
+            # A half-finished sync would leave a hole below the newest stored
+            # message that later delta syncs never revisit.
+            self.store.delete_newer(dialog.id, since)
+            raise
+
+    def rolling_summary(self, dialog):
+        if ConfigManager.get("rolling_summary") is False:
+            return None
+        return self.store.rolling_summary(dialog.id)
+
+    def history_limit(self, dialog):
+        # With a rolling summary the already-read messages are not needed
+        # as context, so only the unread ones are downloaded.
+        context = 0 if self.rolling_summary(dialog) is not None else CONTEXT_MESSAGES
+        return dialog.unread_count + context
+
+    async def load_history(self, dialog):
+        # Returns a History: the already-read context messages, the id of the
+        # first unread message (None when nothing is unread), the newest
+        # stored id and the previous summary if it can stand in for the
+        # context. The unread messages themselves are read from the store
+        # page by page.
+        unread = dialog.unread_count
+        limit = self.history_limit(dialog)
+        await self.sync_history(dialog, limit)
+        self.store.prune(dialog.id, max(limit, ConfigManager.get_int("store_max_messages", STORE_MAX_MESSAGES)))
+        first_unread = self.store.nth_latest_id(dialog.id, unread) if unread else None
+        newest_id = self.store.max_id(dialog.id)
+        rolling = self.rolling_summary(dialog)
+        # The previous summary only replaces the context if it ends before
+        # the first unread message; otherwise it covers part of what is
+        # about to be summarized (the chat was not read since), and stored
+        # messages are used as before.
+        if rolling is not None and first_unread is not None and rolling[0] < first_unread:
+            return History([], first_unread, newest_id, rolling[1])
+        context = self.store.latest(dialog.id, CONTEXT_MESSAGES, before=first_unread)
+        return History(context, first_unread, newest_id, None)
+
+    def save_rolling_summary(self, dialog, history, summary):
+        if history.first_unread is None or ConfigManager.get("rolling_summary") is False:
+            return
+        limit = ConfigManager.get_int("rolling_summary_chars", ROLLING_SUMMARY_CHARS)
+        if len(summary) > limit:
+            summary = summary[:limit].rsplit(" ", 1)[0] + " …"
+        self.store.save_rolling_summary(dialog.id, history.newest_id, summary)
+
+    async def prefetch(self, dialog):
+        # Downloads what summarizing `dialog` will need into the store and
+        # the sender cache; nothing is kept in memory besides sender names.
+        limit = self.history_limit(dialog)
+        await self.sync_history(dialog, limit)
+        await self.resolve_senders(self.store.latest(dialog.id, limit))
+
+    def iter_unread_pages(self, dialog, first_unread, page_size=STORE_PAGE_SIZE):
+        if first_unread is None:
+            return iter(())
+        return self.store.iter_pages(dialog.id, first_unread, page_size)
+
+    async def get_chat_history(self, dialog):
+        history = await self.load_history(dialog)
+        new_msgs = [msg for page in self.iter_unread_pages(dialog, history.first_unread) for msg in page]
+        return new_msgs, history
+
+    def _remember_sender(self, sender_id, entity, limit):
+        self.sender_names[sender_id] = sender_display_name(entity)
+        self.sender_names.move_to_end(sender_id)
+        while len(self.sender_names) > limit:
+            self.sender_names.popitem(last=False)
+
+    async def _fetch_entities(self, ids):
+        from telethon import errors
+
+        def fetch(target):
+            async def call():
+                try:
+                    return await self.client.get_entity(target)
+                except errors.FloodWaitError as e:
+                    raise RateLimitedError(e.seconds, str(e))
+            return call
+
+        async def limited(target):
+            return await self.telegram_limiter.run(
+                fetch(target), ConfigManager.get_int("telegram_max_retries", TELEGRAM_MAX_RETRIES, minimum=0),
+                max_wait=ConfigManager.get_int("flood_wait_max", FLOOD_WAIT_MAX),
+            )
+
+        try:
+            return await limited(ids)
+        except RateLimitedError:
+            # Telegram asked us to back off: go without names ('Unknown')
+            # rather than send it one request per id.
+            return []
+        except (ValueError, errors.RPCError):
+            # One unknown peer fails the whole batch; fall back to resolving
+            # the rest individually so a single bad id costs only its own name.
+            results = await asyncio.gather(*(limited(i) for i in ids), return_exceptions=True)
+            return [r for r in results if not isinstance(r, Exception)]
+
+    async def resolve_senders(self, messages):
+        names = {}
+        missing = set()
+        for msg in messages:
+            sender_id = msg.sender_id
+            if sender_id is None or sender_id in names:
+                continue
+            if sender_id in self.sender_names:
+                self.sender_names.move_to_end(sender_id)
+                names[sender_id] = self.sender_names[sender_id]
+            else:
+                missing.add(sender_id)
+
+        if missing:
+            from telethon import utils
+
+            cache_size = ConfigManager.get_int("entity_cache_size", ENTITY_CACHE_SIZE)
+            for entity in await self._fetch_entities(list(missing)):
+                sender_id = utils.get_peer_id(entity)
+                self._remember_sender(sender_id, entity, cache_size)
+                names[sender_id] = self.sender_names[sender_id]
+        return names
+
+    def get_http_session(self):
+        if self.http_session is None or self.http_session.closed:
+            import aiohttp
+
+            connector = aiohttp.TCPConnector(
+                limit=ConfigManager.get_int("http_pool_size", HTTP_POOL_SIZE),
+                limit_per_host=ConfigManager.get_int("http_pool_per_host", HTTP_POOL_PER_HOST),
+                ttl_dns_cache=ConfigManager.get_int("http_dns_ttl", HTTP_DNS_TTL),
+                keepalive_timeout=ConfigManager.get_int("http_keepalive", HTTP_KEEPALIVE),
+            )
+            self.http_session = aiohttp.ClientSession(
+                connector=connector, trace_configs=[self.http_stats.trace_config()]
+            )
+        return self.http_session
+
+    async def close(self):
+        if self.http_session is not None and not self.http_session.closed:
+            await self.http_session.close()
+        if self.client is not None and self.client.is_connected():
+            await self.client.disconnect()
+        self.store.close()
+        self.summary_cache.close()
+
+    def stats_summary(self):
+        parts = [self.http_stats.summary(), self.summary_cache.summary()]
+        if self.prompt_tokens_verbose:
+            saved = 100 * (1 - self.prompt_tokens_compact / self.prompt_tokens_verbose)
+            parts.append(f"Prompt: {self.prompt_tokens_verbose} -> {self.prompt_tokens_compact} tokens (-{saved:.0f}%)")
+        if self.batch_requests:
+            parts.append(f"Batches: {self.batched_chats} chats in {self.batch_requests} req")
+        if self.hedged_requests:
+            parts.append(f"Hedged: {self.hedged_requests} req, {self.hedges_won} won by the hedge")
+        for backend in self.llm_backends:
+            parts += [backend.summary(), backend.limiter.summary()]
+        parts.append(self.telegram_limiter.summary())
+        return " | ".join(parts)
+
+    def backends(self):
+        # Rebuilt only when the backend settings change, so latency
+        # histograms and limiters survive across requests.
+        config = {name: ConfigManager.get(name) for name in ("llm_backends", "gemini_key", "proxy_base")}
+        key = json.dumps(config, sort_keys=True)
+        if key != self._backends_key:
+            self.llm_backends = build_llm_backends(config)
+            self._backends_key = key
+        return self.llm_backends
+
+    @staticmethod
+    def _api_error(backend, status, result):
+        _, error = backend.reply_text(result)
+        if error and error.startswith(backend.BLOCKED):
+            return error
+        return f"API Error ({status}): {result}"
+
+    async def _error_response(self, backend, response):
+        try:
+            result = await response.json(content_type=None)
+        except Exception:
+            text_err = await response.text()
+            return f"Network error: {response.status} - {text_err}"
+        return self._api_error(backend, response.status, result)
+
+    async def _check_rate_limit(self, response):
+        if response.status not in (429, 503):
+            return
+        try:
+            body = await response.json(content_type=None)
+        except Exception:
+            body = None
+        retry_after = parse_retry_after(response.headers.get('Retry-After'), body)
+        raise RateLimitedError(retry_after, f"API Error ({response.status}): {body}")
+
+    async def _request_llm(self, session, backend, payload):
+        async with session.post(backend.url(False), headers=backend.headers(), json=payload) as response:
+            await self._check_rate_limit(response)
+            try:
+                raw = await response.read()
+                result = await offload(json.loads, raw) if len(raw) >= OFFLOAD_MIN_BYTES else json.loads(raw)
+            except Exception:
+                text_err = await response.text()
+                return None, f"Network error: {response.status} - {text_err}"
+
+            if response.status != 200:
+                return None, self._api_error(backend, response.status, result)
+            return backend.reply_text(result)
+
+    async def _stream_llm(self, session, backend, payload, on_partial):
+        async with session.post(backend.url(True), headers=backend.headers(), json=payload) as response:
+            await self._check_rate_limit(response)
+            if response.status != 200:
+                return None, await self._error_response(backend, response)
+
+            text, error = "", None
+            async for raw_line in response.content:
+                line = raw_line.decode('utf-8').strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    continue
+                chunk, error = backend.event_text(json.loads(data))
+                if chunk:
+                    text += chunk
+                    on_partial(text)
+                elif error and error.startswith(backend.REFUSED):
+                    # Text streamed so far is cut short: it is neither
+                    # cached nor kept as the rolling summary.
+                    return None, error
+            if text:
+                return text, None
+            return None, error or backend.NO_TEXT
+
+    async def _ask_backend(self, backend, system, text, on_partial):
+        stream = on_partial is not None and ConfigManager.get("stream_responses") is not False
+        payload = backend.payload(system, text, stream)
+
+        async def attempt():
+            session = self.get_http_session()
+            started = time.perf_counter()
+            if stream:
+                summary, error = await self._stream_llm(session, backend, payload, on_partial)
+            else:
+                summary, error = await self._request_llm(session, backend, payload)
+            if error is None:
+                backend.on_success(time.perf_counter() - started)
+            return summary, error
+
+        # A Retry-After longer than llm_max_wait is not waited out: the
+        # 429 goes back to the caller, so the next backend or the error
+        # block takes over.
+        max_wait = ConfigManager.get_int("llm_max_wait", LLM_MAX_WAIT, minimum=0)
+        try:
+            return await backend.limiter.run(
+                attempt, ConfigManager.get_int("llm_max_retries", LLM_MAX_RETRIES, minimum=0), max_wait=max_wait,
+            )
+        except RateLimitedError as e:
+            backend.on_failure(e.retry_after)
+            if e.retry_after is not None and e.retry_after > max_wait:
+                return None, f"{e} (retry in {e.retry_after:.0f}s is over llm_max_wait)"
+            return None, f"{e} (gave up after retries)"
+        except Exception as e:
+            backend.on_failure()
+            return None, f"Connection error: {str(e)}"
+
+    async def _hedged_request(self, backends, system, text, on_partial):
+        # Asks the best-ranked backend first. If it has neither answered nor
+        # started streaming within its hedge delay (p95 of its recent
+        # latency), the same prompt also goes to the next backend; the first
+        # answer wins and the other request is cancelled. A backend that
+        # fails passes the prompt on to the next one right away.
+        queue = list(backends)
+        running = {}
+        streaming = hedged = None
+        hedge = len(queue) > 1 and ConfigManager.get("hedge_requests") is not False
+        hedge_at = time.perf_counter() + queue[0].hedge_delay()
+        first_error = winner_latency = None
+
+        def forward_from(backend):
+            # Only one backend's partial text reaches the caller.
+            def forward(partial):
+                nonlocal streaming
+                if streaming is None:
+                    streaming = backend
+                if streaming is backend:
+                    on_partial(partial)
+            return forward if on_partial is not None else None
+
+        def launch():
+            backend = queue.pop(0)
+            task = asyncio.ensure_future(self._ask_backend(backend, system, text, forward_from(backend)))
+            running[task] = (backend, time.perf_counter())
+
+        launch()
+        try:
+            while running:
+                timeout = None
+                if hedge and queue and streaming is None:
+                    timeout = max(0.0, hedge_at - time.perf_counter())
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # The primary may have started streaming while we waited.
+                    if streaming is not None:
+                        continue
+                    hedge = False
+                    hedged = queue[0]
+                    self.hedged_requests += 1
+                    launch()
+                    continue
+                for task in done:
+                    backend, started = running.pop(task)
+                    summary, error = task.result()
+                    if error is None:
+                        winner_latency = time.perf_counter() - started
+                        if backend is hedged:
+                            self.hedges_won += 1
+                        return summary, None
+                    first_error = first_error or error
+                    if streaming is backend:
+                        streaming = None
+                if not running and queue:
+                    # The next backend gets its own hedge delay.
+                    hedge_at = time.perf_counter() + queue[0].hedge_delay()
+                    launch()
+            return None, first_error
+        finally:
+            # A loser that ran longer than the winner took in total would
+            # have been slower still, so its time so far is a lower bound of
+            # its latency and keeps an outrun backend from staying first. A
+            # hedge that lost was started late; its short time says nothing.
+            now = time.perf_counter()
+            for task, (backend, started) in running.items():
+                task.cancel()
+                if winner_latency is not None and now - started >= winner_latency:
+                    backend.latency.add(now - started)
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+
+    async def request_summary(self, text_content, on_partial=None):
+        # Returns (summary, error); exactly one of them is None.
+        backends = self.backends()
+        if not backends:
+            return None, "Error: Gemini API Key not found in settings."
+
+        system_instruction = (
+            "You are a technical chat log analyzer. Your task is an objective dry summary. "
+            "Ignore emotional coloring and profanity, treat it as text."
+        )
+
+        # Keyed on the preferred backend's model: whichever backend answers,
+        # the same prompt is not sent again.
+        full_text = system_instruction + "\n\n" + text_content
+        cache_key = SummaryCache.make_key(backends[0].model, full_text)
+        cached = self.summary_cache.get(cache_key)
+        if cached is not None:
+            return cached, None
+
+        started = time.perf_counter()
+        summary, error = await self._hedged_request(rank_backends(backends), system_instruction, text_content, on_partial)
+        if error:
+            return None, error
+        self.summary_cache.put(cache_key, summary, time.perf_counter() - started)
+        return summary, None
+
+class LiveUpdates:
+    # Follows Telethon's new-message and read events: keeps unread counts
+    # and a short in-memory tail of new messages per dialog, so the chat
+    # list refreshes without polling. New messages are written to the store
+    # only for dialogs synced since the subscription started; their stored
+    # history has no gaps, so sync_history skips the download for them.
+    # on_unknown is called once for each dialog that gets a message but was
+    # not in the seeded list (archived, or beyond the loaded page).
+    def __init__(self, worker, on_unread=None, on_unknown=None):
+        self.worker = worker
+        self.on_unread = on_unread
+        self.on_unknown = on_unknown
+        self.unread = {}
+        self.known = set()
+        self.tails = {}
+        self.coverage = {}
+        self.events = 0
+        self._handlers = []
+
+    def start(self):
+        from telethon import events
+
+        self._handlers = [(self._on_new_message, events.NewMessage()), (self._on_read, events.MessageRead(inbox=True))]
+        for callback, event in self._handlers:
+            self.worker.client.add_event_handler(callback, event)
+        self.worker.live = self
+        return self
+
+    def stop(self):
+        for callback, _ in self._handlers:
+            self.worker.client.remove_event_handler(callback)
+        self._handlers = []
+        if self.worker.live is self:
+            self.worker.live = None
+
+    def seed(self, rows):
+        for row in rows:
+            self.unread[row.id] = row.unread_count
+            self.known.add(row.id)
+
+    def covers(self, dialog_id, limit):
+        return self.coverage.get(dialog_id, -1) >= limit
+
+    def mark_synced(self, dialog_id, limit):
+        # Messages that arrived while the sync was running are in the tail
+        # but not necessarily in the download.
+        tail = self.tails.get(dialog_id)
+        if tail:
+            self.worker.store.add(dialog_id, [record for record, _ in tail])
+        self.coverage[dialog_id] = max(limit, self.coverage.get(dialog_id, 0))
+
+    def forget(self, dialog_id):
+        self.coverage.pop(dialog_id, None)
+
+    def _set_unread(self, dialog_id, count):
+        if self.unread.get(dialog_id) == count:
+            return
+        self.unread[dialog_id] = count
+        if self.on_unread is not None:
+            self.on_unread(dialog_id, count)
+
+    async def _on_new_message(self, event):
+        msg = event.message
+        dialog_id = event.chat_id
+        self.events += 1
+        if msg.sender is not None and msg.sender_id is not None:
+            self.worker._remember_sender(
+                msg.sender_id, msg.sender, ConfigManager.get_int("entity_cache_size", ENTITY_CACHE_SIZE)
+            )
+        record = message_record(msg)
+        self.tails.setdefault(dialog_id, deque(maxlen=HOT_TAIL_SIZE)).append((record, not msg.out))
+        if dialog_id in self.coverage:
+            self.worker.store.add(dialog_id, [record])
+            self.coverage[dialog_id] += 1
+        if not msg.out:
+            self._set_unread(dialog_id, self.unread.get(dialog_id, 0) + 1)
+            if dialog_id not in self.known:
+                self.known.add(dialog_id)
+                if self.on_unknown is not None:
+                    self.on_unknown(dialog_id)
+
+    async def _on_read(self, event):
+        if not event.inbox:
+            return
+        self.events += 1
+        dialog_id = event.chat_id
+        # Telegram sends the remaining count along with inbox reads.
+        still_unread = getattr(event.original_update, "still_unread_count", None)
+        if still_unread is not None:
+            self._set_unread(dialog_id, still_unread)
+            return
+        tail = self.tails.get(dialog_id, ())
+        newer = sum(1 for record, incoming in tail if incoming and record.id > event.max_id)
+        # Otherwise the count is exact only when everything after max_id is
+        # known: the store is complete for a synced dialog, or the tail
+        # reaches back to max_id. Anything else keeps the old count.
+        newest = max(tail[-1][0].id if tail else 0, self.worker.store.max_id(dialog_id))
+        if (dialog_id in self.coverage and event.max_id >= newest) or (tail and tail[0][0].id <= event.max_id):
+            self._set_unread(dialog_id, newer)
+
+    def summary(self):
+        return f"Live: {self.events} events, {len(self.coverage)} chats up to date"
+
+def remember_recent_chats(dialog_ids):
+    previous = ConfigManager.get("recent_chats") or []
+    recent = [dialog_id for dialog_id in previous if dialog_id not in dialog_ids]
+    recent = (list(dialog_ids) + recent)[:RECENT_CHATS_MAX]
+    if recent != previous:
+        ConfigManager.save({"recent_chats": recent})
+
+class Prefetcher:
+    # Warms the store and the sender cache for the chats most likely to be
+    # analyzed next. It runs at low priority: at most PREFETCH_CONCURRENCY
+    # chats at a time, none started while paused for a user-triggered run,
+    # and everything stops at once on cancel.
+    def __init__(self, worker):
+        self.worker = worker
+        self.task = None
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.done = 0
+        self.planned = 0
+
+    @staticmethod
+    def rank(dialogs):
+        # Checked rows first, then recently analyzed chats, then by unread count.
+        recent = {dialog_id: rank for rank, dialog_id in enumerate(ConfigManager.get("recent_chats") or [])}
+        max_unread = ConfigManager.get_int("prefetch_max_unread", PREFETCH_MAX_UNREAD)
+        candidates = [dialog for dialog in dialogs if 0 < dialog.unread_count <= max_unread]
+        candidates.sort(key=lambda d: (not d.checked, recent.get(d.id, len(recent)), -d.unread_count))
+        return candidates[:ConfigManager.get_int("prefetch_max_dialogs", PREFETCH_MAX_DIALOGS, minimum=0)]
+
+    def start(self, dialogs):
+        self.cancel()
+        if ConfigManager.get("prefetch") is False:
+            return
+        queue = self.rank(dialogs)
+        self.done, self.planned = 0, len(queue)
+        self.task = asyncio.create_task(self._run(iter(queue)))
+
+    async def _run(self, queue):
+        async def drain():
+            for dialog in queue:
+                await self.resumed.wait()
+                try:
+                    await self.worker.prefetch(dialog)
+                    self.done += 1
+                except Exception:
+                    # The chat is fetched again, and any error reported, if
+                    # the user analyzes it.
+                    pass
+
+        await asyncio.gather(*(drain() for _ in range(ConfigManager.get_int("prefetch_concurrency", PREFETCH_CONCURRENCY))))
+
+    def pause(self):
+        self.resumed.clear()
+
+    def resume(self):
+        self.resumed.set()
+
+    def cancel(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.task = None
+
+    async def close(self):
+        task, self.task = self.task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def summary(self):
+        return f"Prefetch: {self.done}/{self.planned} chats"
+
+class Scheduler:
+    # Decides the order in which selected chats are started: pinned chats
+    # first, then direct messages, groups and channels, and within each
+    # class the cheapest first, so one huge channel cannot hold back the
+    # small chats behind it. Durations are estimated from the unread volume
+    # and corrected by what finished chats actually took; with a deadline,
+    # work whose estimate no longer fits is not started.
+    KIND_RANK = {"user": 0, "group": 1, "channel": 2}
+
+    def __init__(self, store):
+        self.store = store
+        self.scale = None
+        self._avg_chars = {}
+
+    def tokens(self, dialog):
+        if dialog.id not in self._avg_chars:
+            self._avg_chars[dialog.id] = self.store.avg_text_length(dialog.id) or SCHEDULE_DEFAULT_CHARS
+        return dialog.unread_count * self._avg_chars[dialog.id] / 4
+
+    def order(self, dialogs):
+        pinned = set(ConfigManager.get("pinned_chats") or [])
+        return sorted(dialogs, key=lambda d: (d.id not in pinned, self.KIND_RANK.get(d.kind, 3), self.tokens(d)))
+
+    def _raw_estimate(self, dialogs):
+        # One request's worth of fixed overhead plus time proportional to the
+        # prompt size; a batch of small chats is a single request.
+        return SCHEDULE_BASE_SECONDS + sum(self.tokens(d) for d in dialogs) / SCHEDULE_TOKENS_PER_SECOND
+
+    def estimate(self, dialogs):
+        return self._raw_estimate(dialogs) * (self.scale or 1.0)
+
+    def observe(self, dialogs, seconds):
+        ratio = seconds / self._raw_estimate(dialogs)
+        self.scale = ratio if self.scale is None else 0.7 * self.scale + 0.3 * ratio
+
+    def fits(self, dialogs, deadline):
+        return deadline is None or time.monotonic() + self.estimate(dialogs) <= deadline
+
+class OrderedSlots:
+    # Semaphore that gives a free slot to the waiter with the lowest key
+    # (first come first served among equal keys), so chats start in their
+    # scheduled order no matter when their task got to the semaphore.
+
+    def __init__(self, value):
+        self.value = value
+        self._waiters = []
+        self._count = 0
+
+    async def acquire(self, key):
+        if self.value > 0 and not self._waiters:
+            self.value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (key, self._count, future))
+        self._count += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Cancelled waiters stay in the heap and are skipped by
+            # release(); a slot handed over just before the cancel is
+            # passed on.
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.value += 1
+
+    @asynccontextmanager
+    async def slot(self, key):
+        await self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release()
+
+class DigestPipeline:
+    def __init__(self, worker):
+        self.worker = worker
+        self.scheduler = Scheduler(worker.store)
+
+    async def _ask(self, dialog, prompt, on_partial=None):
+        # Returns (summary, error).
+        with self.worker.metrics.span("llm", dialog.id):
+            return await self.worker.request_summary(prompt, on_partial)
+
+    def _finish(self, dialog, history, summary, error):
+        # The final answer becomes the chat's rolling summary for the next
+        # digest, but only when every part of the chat went through.
+        if error is not None:
+            raise SummaryError(error)
+        self.worker.save_rolling_summary(dialog, history, summary)
+        return summary
+
+    @staticmethod
+    def _encoder():
+        if ConfigManager.get("compact_prompt") is False:
+            return None
+        return PromptEncoder(max_chars=ConfigManager.get_int("compact_max_chars", COMPACT_MAX_CHARS))
+
+    def _count_tokens(self, encoder):
+        if encoder is not None:
+            self.worker.prompt_tokens_verbose += encoder.verbose_tokens
+            self.worker.prompt_tokens_compact += encoder.compact_tokens
+
+    async def _reduce_summaries(self, dialog, summaries, budget, on_partial=None):
+        # Merge partial summaries in budget-sized groups until the remainder
+        # fits into a single final request. Returns (summary, error); a failed
+        # merge fails the whole chat.
+        while len(summaries) > 1 and estimate_tokens("\n\n".join(summaries)) > budget:
+            groups, group, size = [], [], 0
+            for text in summaries:
+                cost = estimate_tokens(text)
+                if group and size + cost > budget:
+                    groups.append(group)
+                    group, size = [], 0
+                group.append(text)
+                size += cost
+            groups.append(group)
+            if len(groups) == len(summaries):
+                break
+            merged = await asyncio.gather(*(
+                self._ask(dialog, build_reduce_prompt(dialog.name, g)) for g in groups
+            ))
+            errors = [error for _, error in merged if error is not None]
+            if errors:
+                return None, errors[0]
+            summaries = [summary for summary, _ in merged]
+        return await self._ask(dialog, build_reduce_prompt(dialog.name, summaries), on_partial)
+
+    async def summarize(self, dialog, on_partial=None):
+        budget = ConfigManager.get_int("chunk_token_budget", CHUNK_TOKEN_BUDGET)
+        fanout = asyncio.Semaphore(ConfigManager.get_int("chunk_fanout", CHUNK_FANOUT))
+        metrics = self.worker.metrics
+        with metrics.span("history", dialog.id):
+            history = await self.worker.load_history(dialog)
+        with metrics.span("senders", dialog.id):
+            sender_names = await self.worker.resolve_senders(history.context)
+        encoder = self._encoder()
+
+        def encode(messages, names):
+            if encoder is None:
+                return format_lines(messages, names)
+            return encoder.encode(messages, names)
+
+        def encode_sized(messages, names):
+            # Returns the lines and the number of messages in each.
+            if encoder is None:
+                return format_lines(messages, names), [1] * len(messages)
+            return encoder.encode(messages, names), encoder.run_sizes
+
+        def legend():
+            return encoder.legend() if encoder is not None else None
+
+        with metrics.span("prompt", dialog.id):
+            if history.previous_summary is not None:
+                context_str = rolling_context(history.previous_summary)
+            else:
+                context_str = "\n".join(encode(history.context, sender_names))
+
+        async def summarize_chunk(part, chunk, chunk_legend):
+            async with fanout:
+                prompt = build_chunk_prompt(dialog.name, part, context_str if part == 1 else "", chunk, chunk_legend)
+                return await self._ask(dialog, prompt)
+
+        # Unread messages are streamed from the store page by page and packed
+        # into chunks that fit the token budget. The first chunk is held back
+        # until a second one proves the backlog needs map-reduce at all; after
+        # that every chunk is sent as soon as it is full.
+        first_chunk, tasks = None, []
+        lines, size = [], estimate_tokens(context_str)
+
+        def flush():
+            nonlocal first_chunk
+            chunk = "\n".join(lines)
+            if first_chunk is None:
+                first_chunk = chunk
+                return
+            if not tasks:
+                tasks.append(asyncio.create_task(summarize_chunk(1, first_chunk, legend())))
+            tasks.append(asyncio.create_task(summarize_chunk(len(tasks) + 1, chunk, legend())))
+
+        try:
+            for page in self.worker.iter_unread_pages(dialog, history.first_unread):
+                with metrics.span("senders", dialog.id):
+                    sender_names = await self.worker.resolve_senders(page)
+                # A page that overflows the chunk is encoded again from the
+                # first message that did not fit, after the chunk is flushed,
+                # so no line refers back to a message in another chunk.
+                while page:
+                    with metrics.span("prompt", dialog.id):
+                        mark = encoder.mark() if encoder is not None else None
+                        if len(page) >= OFFLOAD_MIN_MESSAGES:
+                            page_lines, run_sizes = await offload(encode_sized, page, sender_names)
+                        else:
+                            page_lines, run_sizes = encode_sized(page, sender_names)
+                        fit = taken = 0
+                        for line, run_size in zip(page_lines, run_sizes):
+                            cost = estimate_tokens(line)
+                            if lines and size + cost > budget:
+                                break
+                            lines.append(line)
+                            size += cost
+                            fit += 1
+                            taken += run_size
+                        if fit == len(page_lines):
+                            break
+                        if encoder is not None:
+                            encoder.rewind(mark, page)
+                            encode(page[:taken], sender_names)
+                        flush()
+                        lines, size = [], 0
+                        if encoder is not None:
+                            encoder.start_chunk()
+                        page = page[taken:]
+            if lines or first_chunk is None:
+                flush()
+            self._count_tokens(encoder)
+
+            if not tasks:
+                with metrics.span("prompt", dialog.id):
+                    prompt = build_prompt(dialog.name, context_str, first_chunk, legend())
+                summary, error = await self._ask(dialog, prompt, on_partial)
+                return self._finish(dialog, history, summary, error)
+
+            # A chunk that failed would leave a hole in the summary, so the
+            # first failure fails the chat and the other chunks are dropped.
+            summaries = []
+            for task in tasks:
+                summary, error = await task
+                if error is not None:
+                    raise SummaryError(error)
+                summaries.append(summary)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        summary, error = await self._reduce_summaries(dialog, summaries, budget, on_partial)
+        return self._finish(dialog, history, summary, error)
+
+    async def prepare_batch_item(self, idx, dialog):
+        # Small chats are loaded in one piece: both parts share one encoder,
+        # so message numbers and aliases run on from context into new.
+        metrics = self.worker.metrics
+        with metrics.span("history", dialog.id):
+            new_msgs, history = await self.worker.get_chat_history(dialog)
+        with metrics.span("senders", dialog.id):
+            sender_names = await self.worker.resolve_senders(history.context + new_msgs)
+        encoder = self._encoder()
+        with metrics.span("prompt", dialog.id):
+            if encoder is None:
+                context_str = "\n".join(format_lines(history.context, sender_names))
+                new_str = "\n".join(format_lines(new_msgs, sender_names))
+            else:
+                context_str = "\n".join(encoder.encode(history.context, sender_names))
+                new_str = "\n".join(encoder.encode(new_msgs, sender_names))
+            if history.previous_summary is not None:
+                context_str = rolling_context(history.previous_summary)
+        self._count_tokens(encoder)
+        legend = encoder.legend() if encoder is not None else None
+        return BatchItem(idx, dialog, context_str, new_str, legend, history)
+
+    async def summarize_item(self, item, on_partial=None):
+        prompt = build_prompt(item.dialog.name, item.context_str, item.new_str, item.legend)
+        summary, error = await self._ask(item.dialog, prompt, on_partial)
+        return self._finish(item.dialog, item.history, summary, error)
+
+    async def summarize_batch(self, items):
+        # One request for several chats; returns a summary per item, None for
+        # chats missing from the answer. A refused or empty answer may be
+        # down to one chat's content, so every chat is then retried on its
+        # own. Any other failure (throttling, network) raises SummaryError:
+        # retrying each chat would only pile more requests onto a backend
+        # that is already failing them.
+        with self.worker.metrics.span("prompt"):
+            prompt = build_batch_prompt(items)
+        with self.worker.metrics.span("llm"):
+            answer, error = await self.worker.request_summary(prompt)
+        self.worker.batch_requests += 1
+        self.worker.batched_chats += len(items)
+        if error is not None:
+            if error.startswith(LLMBackend.REFUSED) or error == LLMBackend.NO_TEXT:
+                return [None] * len(items)
+            raise SummaryError(error)
+        summaries = split_batch_response(answer, len(items))
+        for item, summary in zip(items, summaries):
+            if summary is not None:
+                self.worker.save_rolling_summary(item.dialog, item.history, summary)
+        return summaries
+
+    def _batch_candidates(self, dialogs):
+        if ConfigManager.get("batch_small_chats") is False:
+            return set()
+        max_unread = ConfigManager.get_int("batch_max_unread", BATCH_MAX_UNREAD)
+        small = {idx for idx, dialog in enumerate(dialogs) if 0 < dialog.unread_count <= max_unread}
+        return small if len(small) > 1 else set()
+
+    async def _prepare_batched(self, idx, dialog, deadline=None):
+        # Returns (idx, item, error). Loading a small chat takes no slot: its
+        # Telegram calls already go through telegram_limiter.
+        if not self.scheduler.fits([dialog], deadline):
+            return idx, None, ChatSkipped()
+        try:
+            return idx, await self.prepare_batch_item(idx, dialog), None
+        except Exception as e:
+            return idx, None, e
+
+    async def _run_batched(self, prepares, slots, report, partial_for, deadline=None):
+        # Small chats are packed, in the order they become ready, into groups
+        # up to the batch token budget. A chat that does not fit anywhere, or
+        # that the model skipped in its answer, gets a request of its own;
+        # when the batch request fails, its error goes to every chat in it.
+        # The caller holds a slot taken at the position of the first small
+        # chat; the first group is sent on it, later groups wait for a slot
+        # with the position of their own first chat.
+        budget = ConfigManager.get_int("batch_token_budget", BATCH_TOKEN_BUDGET)
+        max_chats = ConfigManager.get_int("batch_max_chats", BATCH_MAX_CHATS)
+        reserved = True
+
+        @asynccontextmanager
+        async def held():
+            try:
+                yield
+            finally:
+                slots.release()
+
+        def group_slot(group):
+            nonlocal reserved
+            if reserved:
+                reserved = False
+                return held()
+            return slots.slot(min(item.idx for item in group))
+
+        async def send(group):
+            async with group_slot(group):
+                group_dialogs = [item.dialog for item in group]
+                if not self.scheduler.fits(group_dialogs, deadline):
+                    for item in group:
+                        report(item.idx, None, ChatSkipped())
+                    return
+                started = time.monotonic()
+                try:
+                    if len(group) == 1:
+                        summaries = [await self.summarize_item(group[0], partial_for(group[0].idx))]
+                    else:
+                        summaries = await self.summarize_batch(group)
+                    missing = [item for item, summary in zip(group, summaries) if summary is None]
+                    retried = await asyncio.gather(
+                        *(self.summarize_item(item) for item in missing), return_exceptions=True
+                    )
+                    by_idx = {item.idx: result for item, result in zip(missing, retried)}
+                    for item, summary in zip(group, summaries):
+                        summary = by_idx.get(item.idx, summary)
+                        if isinstance(summary, BaseException):
+                            report(item.idx, None, summary)
+                        else:
+                            report(item.idx, summary, None)
+                    self.scheduler.observe(group_dialogs, time.monotonic() - started)
+                except Exception as e:
+                    for item in group:
+                        report(item.idx, None, e)
+
+        sends, group, size = [], [], 0
+        try:
+            for future in asyncio.as_completed(prepares):
+                idx, item, error = await future
+                if error is not None:
+                    report(idx, None, error)
+                else:
+                    cost = estimate_tokens(item.context_str) + estimate_tokens(item.new_str)
+                    if group and (size + cost > budget or len(group) >= max_chats):
+                        sends.append(asyncio.create_task(send(group)))
+                        group, size = [], 0
+                    group.append(item)
+                    size += cost
+            if group:
+                sends.append(asyncio.create_task(send(group)))
+            await asyncio.gather(*sends)
+        except BaseException:
+            for task in prepares + sends:
+                task.cancel()
+            raise
+        finally:
+            if reserved:
+                slots.release()
+
+    async def run(self, dialogs, concurrency=None, on_partial=None, time_budget=None):
+        # Yields (index, summary, error) as chats finish, in completion order;
+        # a chat that failed has summary None and the exception as error.
+        # Chats, including the small ones that share batch requests, are
+        # started in list order (see Scheduler.order) with at most
+        # `concurrency` chats or batch requests in flight at once.
+        # With a time budget, chats that would not finish in time get a
+        # ChatSkipped error instead of being started.
+        slots = OrderedSlots(concurrency or ConfigManager.get_int("max_concurrency", DEFAULT_CONCURRENCY))
+        if time_budget is None:
+            time_budget = ConfigManager.get_int("time_budget_seconds", 0, minimum=0)
+        deadline = time.monotonic() + time_budget if time_budget else None
+        self.worker.metrics.reset()
+        results = asyncio.Queue()
+        pending = set(range(len(dialogs)))
+
+        def report(idx, summary, error):
+            if idx in pending:
+                pending.discard(idx)
+                results.put_nowait((idx, summary, error))
+
+        def partial_for(idx):
+            return (lambda text: on_partial(idx, text)) if on_partial else None
+
+        async def run_one(idx, dialog):
+            async with slots.slot(idx):
+                if not self.scheduler.fits([dialog], deadline):
+                    report(idx, None, ChatSkipped())
+                    return
+                started = time.monotonic()
+                try:
+                    report(idx, await self.summarize(dialog, partial_for(idx)), None)
+                    self.scheduler.observe([dialog], time.monotonic() - started)
+                except Exception as e:
+                    report(idx, None, e)
+
+        async def run_batched(first, prepares):
+            try:
+                await slots.acquire(first)
+                await self._run_batched(prepares, slots, report, partial_for, deadline)
+            except Exception as e:
+                for idx in small:
+                    report(idx, None, e)
+
+        # Tasks are created in list order: the batch path waits for its slot
+        # at the position of the first small chat, and small chats start
+        # loading right away.
+        small = self._batch_candidates(dialogs)
+        tasks, prepares = [], []
+        for idx, dialog in enumerate(dialogs):
+            if idx not in small:
+                tasks.append(asyncio.create_task(run_one(idx, dialog)))
+                continue
+            if not prepares:
+                tasks.append(asyncio.create_task(run_batched(idx, prepares)))
+            prepares.append(asyncio.create_task(self._prepare_batched(idx, dialog, deadline)))
+        tasks += prepares
+        try:
+            for _ in range(len(dialogs)):
+                yield await results.get()
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -1,162 +1,116 @@
+import time
+
+STARTED = time.perf_counter()
+
 import sys
 import asyncio
-import urllib.parse
 import html
-import json
-import os
-import aiohttp
-import markdown
 
-from datetime import datetime
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
-                             QHBoxLayout, QListWidget, QListWidgetItem, 
+                             QHBoxLayout, QListView, 
                              QTextBrowser, QPushButton, QLabel, QProgressBar, 
-                             QMessageBox, QStackedWidget, QLineEdit, QDialog)
+                             QMessageBox, QStackedWidget, QLineEdit, QDialog, QMenu)
 # ADDED QTimer to imports here
-from PyQt6.QtCore import Qt, QUrl, QTimer 
-from PyQt6.QtGui import QFont, QDesktopServices, QIcon
+from PyQt6.QtCore import Qt, QUrl, QTimer, QAbstractListModel, QModelIndex
+from PyQt6.QtGui import QFont, QDesktopServices, QIcon, QTextCursor
 
-from telethon import TelegramClient, errors
 import qasync
 
-CONFIG_FILE = "config.json"
-SESSION_NAME = "avatar_session"
-PROXY_BASE = "https://proxy.ganstermaxtivinew.workers.dev/?url="
-
-class ConfigManager:
-    @staticmethod
-    def load():
-        if os.path.exists(CONFIG_FILE):
-            try:
-                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except:
-                return {}
-        return {}
-
-    @staticmethod
-    def save(data):
-        current = ConfigManager.load()
-        current.update(data)
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(current, f, indent=4)
-
-    @staticmethod
-    def get(key):
-        return ConfigManager.load().get(key)
-
-class TelegramWorker:
-    def __init__(self):
-        self.client = None
-        self.phone = None
-        self.phone_code_hash = None
-
-    def init_client(self):
-        api_id = ConfigManager.get("api_id")
-        api_hash = ConfigManager.get("api_hash")
-        if api_id and api_hash:
-            self.client = TelegramClient(SESSION_NAME, int(api_id), api_hash)
-            return True
+from digest import (ConfigManager, TelegramWorker, DigestPipeline, Prefetcher, LoopMonitor, LiveUpdates,
+                    ChatSkipped, offload, markdown_html, remember_recent_chats, load_dialog_snapshot,
+                    save_dialog_snapshot)
+
+STREAM_REPAINT_INTERVAL = 0.1
+# Messages in chats missing from the list trigger one reload after this delay.
+LIVE_RELOAD_DELAY_MS = 3000
+
+class ChatListModel(QAbstractListModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+        self.pinned = set(ConfigManager.get("pinned_chats") or [])
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return f"📌 {row.label}" if row.id in self.pinned else row.label
+        if role == Qt.ItemDataRole.CheckStateRole:
+            return Qt.CheckState.Checked if row.checked else Qt.CheckState.Unchecked
+        if role == Qt.ItemDataRole.UserRole:
+            return row
+        return None
+
+    def setData(self, index, value, role=Qt.ItemDataRole.EditRole):
+        if not index.isValid() or role != Qt.ItemDataRole.CheckStateRole:
+            return False
+        self.rows[index.row()].checked = Qt.CheckState(value) == Qt.CheckState.Checked
+        self.dataChanged.emit(index, index, [role])
+        return True
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.ItemFlag.NoItemFlags
+        return super().flags(index) | Qt.ItemFlag.ItemIsUserCheckable
+
+    def checked_rows(self):
+        return [row for row in self.rows if row.checked]
+
+    def apply_row(self, position, incoming):
+        # Makes `incoming` the row at `position`, moving or inserting it as
+        # needed; rows above `position` are already final for this refresh.
+        current = next((i for i in range(position, len(self.rows)) if self.rows[i].id == incoming.id), None)
+        if current is None:
+            self.beginInsertRows(QModelIndex(), position, position)
+            self.rows.insert(position, incoming)
+            self.endInsertRows()
+            return
+        if current != position:
+            self.beginMoveRows(QModelIndex(), current, current, QModelIndex(), position)
+            self.rows.insert(position, self.rows.pop(current))
+            self.endMoveRows()
+
+        row = self.rows[position]
+        changed = (row.name, row.kind, row.unread_count) != (incoming.name, incoming.kind, incoming.unread_count)
+        row.name, row.kind, row.unread_count = incoming.name, incoming.kind, incoming.unread_count
+        row.entity = incoming.entity
+        if changed:
+            index = self.index(position)
+            self.dataChanged.emit(index, index, [Qt.ItemDataRole.DisplayRole])
+
+    def toggle_pinned(self, position):
+        row = self.rows[position]
+        self.pinned ^= {row.id}
+        ConfigManager.save({"pinned_chats": sorted(self.pinned)})
+        index = self.index(position)
+        self.dataChanged.emit(index, index, [Qt.ItemDataRole.DisplayRole])
+
+    def set_unread(self, dialog_id, count):
+        for position, row in enumerate(self.rows):
+            if row.id == dialog_id:
+                row.unread_count = count
+                index = self.index(position)
+                self.dataChanged.emit(index, index, [Qt.ItemDataRole.DisplayRole])
+                return True
         return False
 
-    async def connect_and_check_auth(self):
-        if not self.client:
-            if not self.init_client():
-                return False
-        
-        await self.client.connect()
-        return await self.client.is_user_authorized()
-
-    async def send_code(self, phone):
-        self.phone = phone
-        try:
-            sent = await self.client.send_code_request(phone)
-            self.phone_code_hash = sent.phone_code_hash
-            return True, "Code sent!"
-        except Exception as e:
-            return False, str(e)
-
-    async def sign_in(self, code, password=None):
-        try:
-            if password:
-                await self.client.sign_in(password=password)
-            else:
-                await self.client.sign_in(self.phone, code, phone_code_hash=self.phone_code_hash)
-            return True, "Successful login!"
-        except errors.SessionPasswordNeededError:
-            return False, "2FA_REQUIRED"
-        except Exception as e:
-            return False, str(e)
-
-    async def get_unread_dialogs(self, limit=120):
-        dialogs = await self.client.get_dialogs(limit=limit, archived=False)
-        return [d for d in dialogs if d.unread_count > 0 or True] #now i'm show all
-
-    async def get_chat_history(self, dialog):
-        unread = dialog.unread_count
-        limit = unread + 30
-        messages = await self.client.get_messages(dialog, limit=limit)
-        return messages[:unread], messages[unread:]
-
-    async def get_gemini_summary(self, text_content):
-        gemini_key = ConfigManager.get("gemini_key")
-        if not gemini_key:
-            return "Error: Gemini API Key not found in settings."
-
-        base_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-flash-latest:generateContent?key={gemini_key}"
-        target_url_encoded = urllib.parse.quote(base_url, safe='')
-        final_url = f"{PROXY_BASE}{target_url_encoded}"
-
-        headers = {'Content-Type': 'application/json'}
-        
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
-        ]
-
-        system_instruction = (
-            "You are a technical chat log analyzer. Your task is an objective dry summary. "
-            "Ignore emotional coloring and profanity, treat it as text."
-        )
-
-        payload = {
-            "contents": [{"parts": [{"text": system_instruction + "\n\n" + text_content}]}],
-            "safetySettings": safety_settings
-        }
-
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(final_url, headers=headers, json=payload) as response:
-                    try:
-                        result = await response.json()
-                    except:
-                        text_err = await response.text()
-                        return f"Network error: {response.status} - {text_err}"
-
-                    if 'promptFeedback' in result:
-                        pf = result['promptFeedback']
-                        if pf.get('blockReason') and pf['blockReason'] != 'BLOCK_REASON_UNSPECIFIED':
-                            return f"⚠️ Content blocked by Google (Hard Block): {pf['blockReason']}"
-
-                    if response.status != 200:
-                        return f"API Error ({response.status}): {result}"
-
-                    try:
-                        return result['candidates'][0]['content']['parts'][0]['text']
-                    except (KeyError, IndexError):
-                        if result.get('candidates') and result['candidates'][0].get('finishReason') == 'SAFETY':
-                            return "⚠️ Google hid the response due to safety settings (Safety Filter)."
-                        return "AI returned no text."
-        except Exception as e:
-            return f"Connection error: {str(e)}"
+    def truncate(self, count):
+        if count < len(self.rows):
+            self.beginRemoveRows(QModelIndex(), count, len(self.rows) - 1)
+            del self.rows[count:]
+            self.endRemoveRows()
 
 class AuthWidget(QWidget):
-    def __init__(self, worker, switch_callback):
+    def __init__(self, worker, switch_callback, input_callback=None):
         super().__init__()
         self.worker = worker
         self.switch_to_main = switch_callback
+        self.input_needed = input_callback
+        self.finished = False
         self.step = 0 
         self.setup_ui()
         self.check_initial_state()
@@ -234,6 +188,10 @@ class AuthWidget(QWidget):
         except Exception as e:
             self.lbl_info.setText(f"Config error: {e}")
             self.set_step_api()
+        # On a warm start the chat list is on screen already; bring the
+        # setup back if the session needs the user.
+        if not self.finished and self.input_needed is not None:
+            self.input_needed()
 
     def set_step_api(self):
         self.step = 0
@@ -305,6 +263,7 @@ class AuthWidget(QWidget):
         self.btn_guide.show()
 
     def finish_setup(self):
+        self.finished = True
         self.switch_to_main()
 
     def on_action_click(self):
@@ -368,17 +327,31 @@ class MainWindow(QMainWindow):
         self.setWindowTitle("Telegram AI Summarizer")
         self.resize(550, 800)
         self.worker = TelegramWorker()
+        self.pipeline = DigestPipeline(self.worker)
+        self.prefetcher = Prefetcher(self.worker)
+        self.loop_monitor = LoopMonitor()
+        self.live = None
+        self._loading_chats = False
+        self.chats_ready = asyncio.Event()
+        # Set whenever no dialog load is under way, whether or not the last
+        # one succeeded (chats_ready tells which).
+        self.chats_settled = asyncio.Event()
+        self.reload_timer = QTimer(self)
+        self.reload_timer.setSingleShot(True)
+        self.reload_timer.setInterval(LIVE_RELOAD_DELAY_MS)
+        self.reload_timer.timeout.connect(lambda: asyncio.create_task(self.load_chats()))
         
         self.setup_ui()
         self.apply_styles()
         
-        self.stack.setCurrentWidget(self.page_auth)
+        if not self.warm_start():
+            self.stack.setCurrentWidget(self.page_auth)
 
     def setup_ui(self):
         self.stack = QStackedWidget()
         self.setCentralWidget(self.stack)
 
-        self.page_auth = AuthWidget(self.worker, self.go_to_app)
+        self.page_auth = AuthWidget(self.worker, self.go_to_app, self.show_auth)
         self.stack.addWidget(self.page_auth)
 
         self.page_selection = QWidget()
@@ -394,7 +367,12 @@ class MainWindow(QMainWindow):
         self.status_label.setStyleSheet("color: #888;")
         sel_layout.addWidget(self.status_label)
 
-        self.chat_list = QListWidget()
+        self.chat_model = ChatListModel(self)
+        self.chat_list = QListView()
+        self.chat_list.setModel(self.chat_model)
+        self.chat_list.setUniformItemSizes(True)
+        self.chat_list.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        self.chat_list.customContextMenuRequested.connect(self.show_chat_menu)
         sel_layout.addWidget(self.chat_list)
         
         self.btn_refresh = QPushButton("UPDATE LIST")
@@ -415,6 +393,11 @@ class MainWindow(QMainWindow):
         self.progress_bar.setTextVisible(True)
         res_layout.addWidget(self.progress_bar)
 
+        self.stats_label = QLabel("")
+        self.stats_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.stats_label.setStyleSheet("color: #888;")
+        res_layout.addWidget(self.stats_label)
+
         self.output_area = QTextBrowser()
         self.output_area.setOpenExternalLinks(True)
         res_layout.addWidget(self.output_area)
@@ -432,15 +415,15 @@ class MainWindow(QMainWindow):
         self.setStyleSheet("""
             QMainWindow { background-color: #2b2b2b; color: #ffffff; }
             QLabel { color: #ffffff; font-family: 'Segoe UI'; }
-            QListWidget { 
+            QListView { 
                 background-color: #363636; 
                 color: #ffffff; 
                 border: none;
                 font-size: 14px;
                 border-radius: 8px;
             }
-            QListWidget::item { padding: 12px; border-bottom: 1px solid #444; }
-            QListWidget::item:hover { background-color: #444; }
+            QListView::item { padding: 12px; border-bottom: 1px solid #444; }
+            QListView::item:hover { background-color: #444; }
             
             QTextBrowser { 
                 background-color: #1e1e1e; 
@@ -483,6 +466,35 @@ class MainWindow(QMainWindow):
             QProgressBar::chunk { background-color: #28a745; border-radius: 4px; }
         """)
 
+    def warm_start(self):
+        # The last dialog list is shown at once while Telegram connects;
+        # load_chats then reconciles it in place.
+        if not (ConfigManager.get("api_id") and ConfigManager.get("api_hash")):
+            return False
+        rows = load_dialog_snapshot()
+        if not rows:
+            return False
+        for position, row in enumerate(rows):
+            self.chat_model.apply_row(position, row)
+        self.status_label.setText(f"Connecting... ({len(rows)} chats from the last session)")
+        self.stack.setCurrentWidget(self.page_selection)
+        QTimer.singleShot(0, lambda: self.mark_startup("first_usable"))
+        return True
+
+    def mark_startup(self, name):
+        # Seconds since process start; the first value of each name wins.
+        self.worker.metrics.mark_startup(name, time.perf_counter() - STARTED)
+
+    def startup_summary(self):
+        startup = self.worker.metrics.startup
+        parts = [f"{name.replace('_', ' ')} {seconds * 1000:.0f} ms" for name, seconds in startup.items()]
+        return "Startup: " + ", ".join(parts) if parts else ""
+
+    def show_auth(self):
+        # No list is coming until the user logs in again.
+        self.chats_settled.set()
+        self.stack.setCurrentWidget(self.page_auth)
+
     def go_to_app(self):
         self.stack.setCurrentWidget(self.page_selection)
         asyncio.create_task(self.load_chats())
@@ -493,114 +505,234 @@ class MainWindow(QMainWindow):
         self.progress_bar.setFormat("")
 
     async def load_chats(self):
+        if self._loading_chats:
+            return
+        self._loading_chats = True
+        self.chats_settled.clear()
+        self.prefetcher.cancel()
         try:
             self.status_label.setText("Updating dialogs...")
-            dialogs = await self.worker.get_unread_dialogs()
-            self.chat_list.clear()
-            
-            if not dialogs:
+            # Rows are merged into the existing model as iter_dialogs yields
+            # them, so checkboxes survive and the first rows show up early.
+            count = 0
+            async for row in self.worker.iter_dialog_rows():
+                self.chat_model.apply_row(count, row)
+                count += 1
+                if count == 1:
+                    QTimer.singleShot(0, lambda: self.mark_startup("first_usable"))
+            self.chat_model.truncate(count)
+            self.mark_startup("list_synced")
+            self.chats_ready.set()
+            save_dialog_snapshot(self.chat_model.rows)
+            # From here on unread counts follow Telegram's update events;
+            # UPDATE LIST is only needed to pick up reordering.
+            if self.live is None and ConfigManager.get("live_updates") is not False:
+                self.live = LiveUpdates(self.worker, self.on_live_unread, self.on_live_unknown).start()
+            if self.live is not None:
+                self.live.seed(self.chat_model.rows)
+
+            if not count:
                 self.status_label.setText("No unread messages.")
                 return
 
-            for dialog in dialogs:
-                item = QListWidgetItem()
-                chat_type = "📢" if dialog.is_channel else "👥" if dialog.is_group else "👤"
-                item.setText(f"{chat_type} {dialog.name} (+{dialog.unread_count})")
-                item.setFlags(item.flags() | Qt.ItemFlag.ItemIsUserCheckable)
-                item.setCheckState(Qt.CheckState.Unchecked)
-                item.setData(Qt.ItemDataRole.UserRole, dialog)
-                self.chat_list.addItem(item)
-            
-            self.status_label.setText(f"Active chats: {len(dialogs)}")
+            startup = self.startup_summary()
+            self.status_label.setText(f"Active chats: {count}" + (f" | {startup}" if startup else ""))
+            # Histories and senders of the likeliest picks are fetched while
+            # the user is still choosing.
+            self.prefetcher.start(self.chat_model.rows)
 
         except Exception as e:
             QMessageBox.critical(self, "Error", str(e))
             self.status_label.setText("Load error")
+        finally:
+            self._loading_chats = False
+            self.chats_settled.set()
+
+    def show_chat_menu(self, point):
+        index = self.chat_list.indexAt(point)
+        if not index.isValid():
+            return
+        row = self.chat_model.rows[index.row()]
+        menu = QMenu(self.chat_list)
+        # Pinned chats are analyzed before all others.
+        action = menu.addAction("Unpin" if row.id in self.chat_model.pinned else "Pin (analyze first)")
+        if menu.exec(self.chat_list.viewport().mapToGlobal(point)) is action:
+            self.chat_model.toggle_pinned(index.row())
+
+    def on_live_unread(self, dialog_id, count):
+        self.chat_model.set_unread(dialog_id, count)
+
+    def on_live_unknown(self, dialog_id):
+        # A chat that is not in the list got a new message. Restarting the
+        # timer folds a burst of such chats into a single reload.
+        self.reload_timer.start()
+
+    def _chat_block(self, dialog, summary_html_content):
+        return f"""
+        <div style="background-color: #262626; padding: 15px; margin-bottom: 15px; border-radius: 10px; border-left: 4px solid #0078d4;">
+            <h2 style="color: #4da6ff; margin: 0 0 10px 0; font-size: 18px;">
+                {dialog.name} <span style="font-size: 14px; color: #aaa; font-weight: normal;">(+{dialog.unread_count})</span>
+            </h2>
+            <div style="color: #dddddd; line-height: 1.5; font-size: 15px;">
+                {summary_html_content}
+            </div>
+        </div>
+        """
+
+    async def _render_summary(self, dialog, summary_raw):
+        try:
+            summary_html_content = await offload(markdown_html, summary_raw)
+        except Exception:
+            safe_text = html.escape(summary_raw).replace('\n', '<br>')
+            summary_html_content = f"<div style='color: #ffcccc;'>{safe_text}</div>"
+
+        return self._chat_block(dialog, summary_html_content)
 
-    async def _format_messages(self, messages):
-        text_lines = []
-        for msg in reversed(messages):
-            sender = await msg.get_sender()
-            name = getattr(sender, 'first_name', None) or getattr(sender, 'title', 'Unknown')
-            content = msg.text or "[Media/Sticker]"
-            meta = f"[ID:{msg.id}]"
-            if msg.reply_to_msg_id:
-                meta += f" [ReplyTo:{msg.reply_to_msg_id}]"
-            text_lines.append(f"{meta} {name}: {content}")
-        return "\n".join(text_lines)
+    def _report_metrics(self, commit_block):
+        metrics = self.worker.metrics
+        if not metrics.enabled:
+            return
+        table = html.escape(f"{metrics.summary_table()}\n\n{self.startup_summary()}")
+        commit_block(f"<h3 style='color:#888'>Stage timings</h3><pre style='color:#aaa'>{table}</pre>")
+        stalls = self.loop_monitor.report()
+        if stalls:
+            commit_block(f"<h3 style='color:#888'>UI stalls</h3><pre style='color:#aaa'>{html.escape(stalls)}</pre>")
+        export_path = ConfigManager.get("metrics_export")
+        if export_path:
+            try:
+                metrics.export(export_path)
+            except OSError as e:
+                self.stats_label.setText(f"Metrics export failed: {e}")
 
     async def start_processing(self):
-        selected_items = []
-        for i in range(self.chat_list.count()):
-            item = self.chat_list.item(i)
-            if item.checkState() == Qt.CheckState.Checked:
-                selected_items.append(item)
+        dialogs = self.chat_model.checked_rows()
 
-        if not selected_items:
+        if not dialogs:
             QMessageBox.warning(self, "Oops!", "You haven't selected any chats.")
             return
 
+        # One analysis at a time: a second one would write into the same
+        # results document and send every request again.
+        self.btn_process.setEnabled(False)
+        try:
+            if any(dialog.entity is None for dialog in dialogs):
+                # Rows from the startup snapshot are usable once the live
+                # list has been loaded.
+                self.status_label.setText("Waiting for Telegram...")
+                if not self.chats_ready.is_set():
+                    await self.chats_settled.wait()
+                if not self.chats_ready.is_set():
+                    QMessageBox.warning(self, "Error", "The chat list could not be loaded. Press UPDATE LIST and try again.")
+                    return
+                dialogs = self.chat_model.checked_rows()
+                if not dialogs:
+                    return
+
+            remember_recent_chats([dialog.id for dialog in dialogs])
+            # Results are shown in the order the chats are started in.
+            if ConfigManager.get("schedule_chats") is not False:
+                dialogs = self.pipeline.scheduler.order(dialogs)
+            self.prefetcher.pause()
+            try:
+                await self._analyze(dialogs)
+            finally:
+                self.prefetcher.resume()
+        finally:
+            self.btn_process.setEnabled(True)
+
+    async def _analyze(self, dialogs):
         self.output_area.clear()
         self.output_area.setHtml("<h3 style='color:#888'>Generating summary...</h3>")
         self.stack.setCurrentWidget(self.page_results)
         
-        self.progress_bar.setRange(0, len(selected_items))
+        self.progress_bar.setRange(0, len(dialogs))
         self.progress_bar.setValue(0)
+        self.progress_bar.setFormat("Analysis: %v/%m")
         self.btn_back.setEnabled(False)
 
-        full_html_output = ""
-
-        for idx, item in enumerate(selected_items):
-            dialog = item.data(Qt.ItemDataRole.UserRole)
-            self.progress_bar.setFormat(f"Analysis: {dialog.name}...")
-            
-            try:
-                new_msgs, old_msgs = await self.worker.get_chat_history(dialog)
-                
-                context_str = await self._format_messages(old_msgs)
-                new_str = await self._format_messages(new_msgs)
-                
-                prompt = (
-                    f"Role: Personal Assistant. Analyze the correspondence in chat '{dialog.name}'.\n"
-                    f"IMPORTANT: Messages have format '[ID:...] [ReplyTo:...] Name: Text'. "
-                    f"IMPORTANT: Answer in main language of chat messages"
-                    f"Use ReplyTo to understand who is replying to whom.\n\n"
-                    f"--- CONTEXT (already read) ---\n{context_str}\n"
-                    f"================================\n"
-                    f"--- NEW MESSAGES (summarize these) ---\n{new_str}\n\n"
-                    f"TASK: Write a brief summary of the NEW messages."
-                )
-
-                summary_raw = await self.worker.get_gemini_summary(prompt)
-                
-                try:
-                    summary_html_content = markdown.markdown(summary_raw, extensions=['tables', 'fenced_code'])
-                except Exception:
-                    safe_text = html.escape(summary_raw).replace('\n', '<br>')
-                    summary_html_content = f"<div style='color: #ffcccc;'>{safe_text}</div>"
-
-                chat_block = f"""
-                <div style="background-color: #262626; padding: 15px; margin-bottom: 15px; border-radius: 10px; border-left: 4px solid #0078d4;">
-                    <h2 style="color: #4da6ff; margin: 0 0 10px 0; font-size: 18px;">
-                        {dialog.name} <span style="font-size: 14px; color: #aaa; font-weight: normal;">(+{dialog.unread_count})</span>
-                    </h2>
-                    <div style="color: #dddddd; line-height: 1.5; font-size: 15px;">
-                        {summary_html_content}
-                    </div>
-                </div>
-                """
-                full_html_output += chat_block
-                self.output_area.setHtml(full_html_output)
-                self.output_area.moveCursor(self.output_area.textCursor().MoveOperation.End)
-
-            except Exception as e:
-                err_block = f"<div style='color:red; padding:10px;'>Error with {dialog.name}: {e}</div>"
-                full_html_output += err_block
-                self.output_area.setHtml(full_html_output)
-            
-            self.progress_bar.setValue(idx + 1)
-
-        self.progress_bar.setFormat("Done!")
+        # Chats finish in any order, but blocks are shown in selection order:
+        # a finished block waits until every block above it is ready. While
+        # the first unfinished chat streams, its partial text is shown below
+        # the finished blocks.
+        blocks = [None] * len(dialogs)
+        partials = {}
+        next_block = 0
+        last_paint = 0.0
+
+        # Finished blocks are appended to the document once and never touched
+        # again; only the tail after tail_start (the streaming block) is
+        # replaced, so each repaint lays out just the new content.
+        document = self.output_area.document()
+        document.setUndoRedoEnabled(False)
+        placeholder_shown = True
+        tail_start = 0
+
+        def write_tail(block_html):
+            nonlocal placeholder_shown
+            scroll = self.output_area.verticalScrollBar()
+            position = scroll.value()
+            follow = position >= scroll.maximum() - 4
+            if placeholder_shown:
+                document.clear()
+                placeholder_shown = False
+            cursor = QTextCursor(document)
+            cursor.setPosition(tail_start)
+            cursor.movePosition(QTextCursor.MoveOperation.End, QTextCursor.MoveMode.KeepAnchor)
+            cursor.removeSelectedText()
+            if block_html:
+                if tail_start > 0:
+                    cursor.insertBlock()
+                cursor.insertHtml(block_html)
+            scroll.setValue(scroll.maximum() if follow else position)
+
+        def commit_block(block_html):
+            nonlocal tail_start
+            write_tail(block_html)
+            tail_start = document.characterCount() - 1
+
+        def paint():
+            nonlocal last_paint
+            if next_block in partials:
+                partial_html = html.escape(partials[next_block]).replace('\n', '<br>')
+                write_tail(self._chat_block(dialogs[next_block], partial_html))
+            last_paint = time.perf_counter()
+
+        def on_partial(idx, text):
+            partials[idx] = text
+            if idx == next_block and time.perf_counter() - last_paint >= STREAM_REPAINT_INTERVAL:
+                paint()
+
+        done = skipped = 0
+        async for idx, summary_raw, error in self.pipeline.run(dialogs, on_partial=on_partial):
+            dialog = dialogs[idx]
+            with self.worker.metrics.span("render", dialog.id):
+                if error is None:
+                    blocks[idx] = await self._render_summary(dialog, summary_raw)
+                elif isinstance(error, ChatSkipped):
+                    skipped += 1
+                    blocks[idx] = f"<div style='color:#888; padding:10px;'>Skipped {dialog.name}: {error}</div>"
+                else:
+                    blocks[idx] = f"<div style='color:red; padding:10px;'>Error with {dialog.name}: {error}</div>"
+            done += 1
+            partials.pop(idx, None)
+            self.progress_bar.setValue(done)
+            self.progress_bar.setFormat(f"Analysis: {done}/{len(dialogs)} ({dialogs[idx].name} done)")
+            stats = self.worker.stats_summary()
+            if self.loop_monitor.lags:
+                stats = f"{stats} | {self.loop_monitor.summary()}"
+            self.stats_label.setText(stats)
+
+            if idx != next_block:
+                continue
+            while next_block < len(blocks) and blocks[next_block] is not None:
+                with self.worker.metrics.span("render", dialogs[next_block].id):
+                    commit_block(blocks[next_block])
+                blocks[next_block] = ""
+                next_block += 1
+            paint()
+
+        self._report_metrics(commit_block)
+        self.progress_bar.setFormat(f"Done! ({skipped} skipped, time budget)" if skipped else "Done!")
         self.btn_back.setEnabled(True)
 
 def main():
@@ -612,7 +744,16 @@ def main():
     window.show()
 
     with loop:
+        if ConfigManager.get("loop_monitor") is not False:
+            loop.call_soon(window.loop_monitor.start)
         loop.run_forever()
+        if window.live is not None:
+            window.live.stop()
+        loop.run_until_complete(window.loop_monitor.stop())
+        loop.run_until_complete(window.prefetcher.close())
+        loop.run_until_complete(window.worker.close())
+        if window.chats_ready.is_set():
+            save_dialog_snapshot(window.chat_model.rows)
 
 if __name__ == "__main__":
     main()